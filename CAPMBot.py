@@ -6,22 +6,35 @@ from fmclient import Agent, Session
 from fmclient import Order, OrderSide, OrderType
 
 from enum import Enum
+import os
 import numpy as np
-from itertools import permutations, combinations
+from itertools import combinations
+import heapq
+import copy
+import threading
 from datetime import datetime
 import math
-import random
+
+from instrumentation import Instrumentation
+from order_pipeline import OrderPipeline, TokenBucket
+from scheduler import DecisionScheduler
+from payoff_statistics import parse_description, state_probabilities, common_probabilities, weighted_statistics, \
+    weighted_mean, weighted_covariance_rows
 
 # Submission details
 SUBMISSION = {"student_number": "1080783", "name": "Calvin Ho"}
 
-FM_ACCOUNT = "regular-idol"
-FM_EMAIL = "calvin1@student.unimelb.edu.au"
-FM_PASSWORD = "1080783"
-MARKETPLACE_ID = 1185  # replace this with the marketplace id
+# Account credentials are read from the environment (FM_ACCOUNT, FM_EMAIL, FM_PASSWORD) when run as a script
+MARKETPLACE_ID = 1185  # default marketplace id - override with FM_MARKETPLACE_ID
 
 CONVERT_TO_DOLLARS = 1/100
-STATE_PROBABILITY = 1/4
+
+# Sell orders may take available units at most this far below zero (short selling)
+MAX_SHORT_UNITS = 1
+
+# Minimum seconds between runs of the periodic tasks (running decision passes held back by the decision interval and
+# sending orders held back by the rate limit)
+PERIODIC_TASK_INTERVAL = 0.05
 
 
 class OrderStatus(Enum):
@@ -34,7 +47,10 @@ class OrderStatus(Enum):
 
 class CAPMBot(Agent):
 
-    def __init__(self, account, email, password, marketplace_id, risk_penalty=0.007, session_time=20):
+    def __init__(self, account, email, password, marketplace_id, risk_penalty=0.007, session_time=20,
+                 instrumentation=None, async_orders=False, max_orders_per_second=20, proactive_orders=1,
+                 decision_interval=0.0, shared_statistics=None, journal=None, state_probabilities=None,
+                 statistics_dtype=np.float64, max_cancels_per_second=5):
         """
         Constructor for the Bot
         :param account: Account name
@@ -43,60 +59,176 @@ class CAPMBot(Agent):
         :param marketplace_id: id of the marketplace
         :param risk_penalty: Penalty for risk
         :param session_time: Total trading time for one session
+        :param instrumentation: Instrumentation for timers/ counters (defaults to in-process only)
+        :param async_orders: send orders from a worker thread rather than inline at the end of each callback - only if
+                             the marketplace client allows orders to be sent from threads other than its own
+        :param max_orders_per_second: rate limit for sending orders (None for no limit)
+        :param proactive_orders: maximum number of proactive orders sent per callback
+        :param decision_interval: minimum seconds between decision passes - order updates arriving in between are
+                                  coalesced into the next pass, run from the next callback or periodic task
+        :param shared_statistics: (securities, payoffs in cents, state probabilities, mean payoffs, covariance matrix)
+                                  shared between bots, e.g. held in shared memory by the bot host - used instead of
+                                  computing the payoff statistics while the payoffs and probabilities match
+        :param journal: optional OrderJournal recording received orders, holdings, sessions and own order changes
+        :param state_probabilities: probability of each state - defaults to the probabilities given in the market
+                                    descriptions, or equally likely states
+        :param statistics_dtype: precision used to compute payoff statistics (np.float32 for large state spaces)
+        :param max_cancels_per_second: rate limit for cancelling (and repricing) resting orders (None for no limit)
         """
         super().__init__(account, email, password, marketplace_id, name="CAPM Bot")
-        self._payoffs = {}
+        self._metrics = instrumentation if instrumentation is not None else Instrumentation()
+        self._shared_statistics = shared_statistics
+        self._state_probabilities = state_probabilities
+        self._statistics_dtype = statistics_dtype
+
+        # Raw market description last parsed for each security - unchanged descriptions are not re-parsed - and the
+        # state probabilities it gave (None for equally likely states)
+        self._market_descriptions = {}
+        self._described_probabilities = {}
+        self._journal = journal
         self._risk_penalty = risk_penalty
         self._session_time = session_time
         self._market_ids = {}
+        self._proactive_orders = proactive_orders
 
-        self.cash_available = None
-        self.cash = None
-        self.units_available_holdings = {}
-        self.units_holdings = {}
+        # Payoffs, payoff statistics and settled/ available holdings in arrays ordered by a stable security index
+        self._state = _PortfolioState()
+
+        # Market ids and price ranges in security index order
+        self._index_market_ids = []
+        self._market_min_prices = None
+        self._market_max_prices = None
+        self._market_price_ticks = None
+
+        # Cached Sigma x term - refreshed whenever settled holdings change
+        self.covariance_holdings = None
+
+        # Single unit reservation bid/ ask prices (cents) for every market - refreshed alongside holdings
+        self.reservation_bids = None
+        self.reservation_asks = None
+
+        # Own orders, tracked by ref through their lifecycle (sent -> accepted -> traded/ cancelled)
+        self._own_orders = _OwnOrderTracker(self._own_order_changed)
 
-        self.unit_asset_payoffs = None
-        self.asset_variances = None
-        self.asset_covariances = None
+        # Order updates are applied as they arrive, the decision pass runs at most once per decision interval - a
+        # pass held back by the interval runs from the next callback or the periodic task, so decisions only run on
+        # the callback thread. Callbacks hold the state lock
+        self._state_lock = threading.RLock()
+        self._decision_scheduler = DecisionScheduler(self._decision_pass, decision_interval,
+                                                     instrumentation=self._metrics)
 
-        self.current_performance = None
-        self.potential_performance = None
+        # Decisions only queue orders - they are sent (rate limited) by the order pipeline
+        self._order_pipeline = OrderPipeline(self.send_order, max_orders_per_second, threaded=async_orders,
+                                             on_dropped=self._order_dropped,
+                                             is_cancel=lambda order: order.order_type == OrderType.CANCEL,
+                                             instrumentation=self._metrics)
 
-        self.sent_order_dict = {}
-        self.pending_order_dict = {}
-        self.traded_order_dict = {}
+        # Resting orders are cancelled/ repriced when they stop improving performance, or to make room for more
+        # valuable quotes - at most max_cancels_per_second
+        self._cancel_rate_limit = TokenBucket(max_cancels_per_second, max(1, max_cancels_per_second or 1))
+
+        # Local copy of the order book - updated incrementally from the orders passed to received_orders
+        self._order_book = _LocalOrderBook()
+        self._order_book_seeded = False
+
+    @property
+    def cash(self):
+        return self._state.cash
+
+    @property
+    def cash_available(self):
+        return self._state.cash_available
+
+    @property
+    def units_holdings(self):
+        return self._state.units_dict()
+
+    @property
+    def units_available_holdings(self):
+        return self._state.units_available_dict()
+
+    @property
+    def sent_order_dict(self):
+        return self._own_orders.orders(OrderStatus.SENT)
+
+    @property
+    def pending_order_dict(self):
+        return self._own_orders.orders(OrderStatus.ACCEPTED)
+
+    @property
+    def traded_order_dict(self):
+        return self._own_orders.orders(OrderStatus.TRADED)
 
     def initialised(self):
         """
         Extract payoff distribution for each security and extract information about each market
         """
+        securities = []
+        payoffs = []
         for market_id, market_info in self.markets.items():
-            security = market_info.item
-            description = market_info.description
-            self._payoffs[security] = [int(a) for a in description.split(",")]
+            security_payoffs, security_probabilities = parse_description(market_info.description)
+            securities.append(market_info.item)
+            payoffs.append(security_payoffs)
+            self._market_descriptions[market_info.item] = market_info.description
+            self._described_probabilities[market_info.item] = security_probabilities
             self._market_ids[market_id] = market_info
 
+        self._state.set_payoffs(securities, payoffs)
+        self._state.probabilities = self._resolve_state_probabilities()
+
         self.inform("Bot initialised, I have the payoffs for the states.")
 
+    def _resolve_state_probabilities(self):
+        """
+        State probabilities from the config, otherwise from the current market descriptions - a description without
+        probabilities describes equally likely states, and every description must describe the same probabilities
+        :return: array of state probabilities
+        """
+        no_states = self._state.payoffs.shape[1]
+        if self._state_probabilities is not None:
+            return state_probabilities(no_states, self._state_probabilities)
+        return common_probabilities(no_states, self._described_probabilities.values())
+
     def _calculate_performance(self, units, cash):
+        """
+        Vectorised Calculation of Performance: mu . x + cash - b * x^T Sigma x
+        :param units: holdings vector, ordered by the security index
+        :param cash:
+        :return:
+        """
+        expected_payoff = cash + self._state.mean_payoffs @ units
+        payoff_variance = units @ self._state.covariance_matrix @ units
+
+        return expected_payoff - (self._risk_penalty * payoff_variance)
+
+    def _calculate_performance_reference(self, units, cash):
         """
         Raw Calculation of Performance by calculating Expected Payoff and Payoff Variance
-        :param units:
+        Kept as a reference implementation to check the vectorised calculation against - the expected payoffs,
+        variances and per-pair covariances are computed here from the payoffs, independently of the pre-calculated
+        mean payoffs and covariance matrix
+        :param units: dictionary of unit holdings keyed by security
         :param cash:
         :return:
         """
+        state = self._state
         expected_payoff = cash
         payoff_variance = 0
 
+        # Convert Payoffs into Dollars
+        payoff_dollars = {security: state.payoffs[state.index[security]] * CONVERT_TO_DOLLARS for security in units}
+
         for unit in units.keys():
-            expected_payoff += units[unit] * (self.unit_asset_payoffs[unit])
-            payoff_variance += math.pow(units[unit], 2) * self.asset_variances[unit]
+            expected_payoff += units[unit] * np.average(payoff_dollars[unit], weights=state.probabilities)
+            payoff_variance += math.pow(units[unit], 2) * \
+                np.cov(payoff_dollars[unit], aweights=state.probabilities, bias=True)
 
         all_cov_comb = combinations(units.keys(), 2)
 
         for security_comb in all_cov_comb:
-            payoff_variance += \
-                2 * units[security_comb[0]] * units[security_comb[1]] * self.asset_covariances[security_comb]
+            cov_pair = np.cov(payoff_dollars[security_comb[0]], payoff_dollars[security_comb[1]],
+                              aweights=state.probabilities, bias=True)[0][1]
+            payoff_variance += 2 * units[security_comb[0]] * units[security_comb[1]] * cov_pair
 
         performance = expected_payoff - (self._risk_penalty * payoff_variance)
 
@@ -111,47 +243,42 @@ class CAPMBot(Agent):
         """
 
         # Get settled holdings and settled cash
-        current_performance_cash = (self.cash * CONVERT_TO_DOLLARS)
-        current_performance_holdings = self.units_holdings.copy()
+        current_performance_cash = (self._state.cash * CONVERT_TO_DOLLARS)
+        current_performance_holdings = self._state.units.astype(float)
 
         # if we are calculating the potential performance by trading an order => adjust holdings and cash
         if potential_order:
+            order_index = self._state.index[order_item]
+
             # if the order is to buy
             if order_side == OrderSide.BUY:
                 current_performance_cash -= (order_price * CONVERT_TO_DOLLARS)
-                current_performance_holdings[order_item] = \
-                    current_performance_holdings[order_item] + 1
+                current_performance_holdings[order_index] += 1
 
             # if the order is to sell
             elif order_side == OrderSide.SELL:
                 current_performance_cash += (order_price * CONVERT_TO_DOLLARS)
-                current_performance_holdings[order_item] = \
-                    current_performance_holdings[order_item] - 1
+                current_performance_holdings[order_index] -= 1
 
         # calculate performance
         current_performance = self._calculate_performance(current_performance_holdings, current_performance_cash)
 
         return current_performance
 
-    def get_potential_performance(self, orders):
+    def _performance_deltas(self, asset_indices, directions, prices, units=1):
         """
-        Returns the portfolio performance if the given list of orders is executed.
-        The performance as per the following formula:
-        Performance = ExpectedPayoff - b * PayoffVariance, where b is the penalty for risk
-        :param orders: list of orders
-        :return:
+        Change in performance from trading k units of assets at given prices, for arrays of trades
+        As the objective is quadratic, a k unit trade in asset i changes performance by
+        k * (+/- mu_i -/+ price) - b * (+/- 2k * (Sigma x)_i + k^2 * Sigma_ii)
+        :param asset_indices: security index of each trade
+        :param directions: +1 to buy, -1 to sell
+        :param prices: prices in cents
+        :param units: units of each trade
+        :return: array of performance changes
         """
-
-        # Gets Potential Performance if Current Orders from the Market are Traded
-        # Ex. If the order from the market is to buy => our order would be to sell to the market and vice versa
-        if orders.order_side == OrderSide.BUY:
-            potential_performance = \
-                self._calculate_current_performance(orders, orders.market.item, orders.price, OrderSide.SELL)
-        else:
-            potential_performance = \
-                self._calculate_current_performance(orders, orders.market.item, orders.price, OrderSide.BUY)
-
-        return potential_performance
+        return units * directions * (self._state.mean_payoffs[asset_indices] - prices * CONVERT_TO_DOLLARS) - \
+            self._risk_penalty * (2 * units * directions * self.covariance_holdings[asset_indices] +
+                                  units ** 2 * self._state.covariance_matrix[asset_indices, asset_indices])
 
     def is_portfolio_optimal(self):
         """
@@ -159,168 +286,537 @@ class CAPMBot(Agent):
         :return:
         """
 
-        # Assumes that the current portfolio is optimal, unless proven otherwise
-        portfolio_optimal_flag = True
+        with self._metrics.timer("is_portfolio_optimal"):
+            # Assumes that the current portfolio is optimal, unless proven otherwise
+            portfolio_optimal_flag = True
 
-        for order_id, order in Order.all().items():
-            # update my order statuses
-            self._update_trade_status(order)
+            # Only the best public bid and ask in each market need to be scored: the performance change of trading
+            # against an order only gets worse as the price moves away from the top of the book
+            public_orders = self._order_book.best_public_orders()
 
-            # If the order is pending and not our order
-            if order.is_pending and not order.mine:
+            # Score the top of book orders in one pass - if any improves performance, rebalance towards the
+            # optimal holdings across all markets with multi-unit orders
+            ranked_orders = self._score_public_orders(public_orders)
 
-                # calculate the potential performance if we traded this public order
-                potential_performance = self.get_potential_performance(order)
+            if ranked_orders and ranked_orders[0][0] > 0:
+                for order_market, trade_side, order_price, order_units in self._rebalance_orders(public_orders):
+                    self._take_performance_improvement(order_market, trade_side, order_price, order_units)
 
-                # calculate current performance based off settled holdings/ cash
-                self.current_performance = self._calculate_current_performance()
+                # as there exists a public order that would improve our performance, our portfolio is not optimal
+                portfolio_optimal_flag = False
 
-                # if trading the public order improves performance => trade it if we can
-                if potential_performance > self.current_performance:
+        return portfolio_optimal_flag
 
-                    # Note: Our trade will take the opposite order side of the market trade
-                    if order.order_side == OrderSide.BUY:
-                        self._take_performance_improvement(order.market, OrderSide.SELL, order.price)
-                    elif order.order_side == OrderSide.SELL:
-                        self._take_performance_improvement(order.market, OrderSide.BUY, order.price)
+    def _score_public_orders(self, public_orders):
+        """
+        Score the performance change from trading against every given public order in a single vectorised pass
+        Note: Our trade will take the opposite order side of the market trade
+        :param public_orders: list of pending public orders
+        :return: list of (performance delta, order, our order side), ranked from best to worst
+        """
+        self._metrics.count("orders_scanned", len(public_orders))
+        self._metrics.count("performance_evaluations", len(public_orders))
 
-                    # as there exists a public order that would improve our performance, our portfolio is not optimal
-                    portfolio_optimal_flag = False
-                    break
+        if not public_orders:
+            return []
 
-        return portfolio_optimal_flag
+        no_orders = len(public_orders)
+        asset_indices = np.fromiter((self._state.index[order.market.item] for order in public_orders),
+                                    dtype=int, count=no_orders)
+        directions = np.fromiter((-1 if order.order_side == OrderSide.BUY else 1 for order in public_orders),
+                                 dtype=float, count=no_orders)
+        prices = np.fromiter((order.price for order in public_orders), dtype=float, count=no_orders)
 
-    def order_accepted(self, order):
-        for order_ref, sent_order in self.sent_order_dict.items():
-            if order.ref == order_ref:
-                # remove from sent list, add to pending list
-                self.sent_order_dict[order_ref].order_status = OrderStatus(1)
+        performance_deltas = self._performance_deltas(asset_indices, directions, prices)
 
-                self.pending_order_dict[order_ref] = self.sent_order_dict[order_ref]
-                self.sent_order_dict.pop(order_ref)
-                break
+        ranked_orders = []
+        for order_index in np.argsort(-performance_deltas, kind="stable"):
+            order = public_orders[order_index]
+            trade_side = OrderSide.BUY if directions[order_index] > 0 else OrderSide.SELL
+            ranked_orders.append((performance_deltas[order_index], order, trade_side))
+
+        return ranked_orders
+
+    def order_accepted(self, order):
+        # move from sent to pending, keeping the fm id the marketplace gave the order
+        with self._state_lock:
+            current_order = self._own_orders.get(order.ref)
+            if current_order is not None:
+                current_order.fm_id = order.fm_id
+            self._own_orders.transition(order.ref, OrderStatus.ACCEPTED)
+            self._decision_scheduler.run_pending()
 
     def order_rejected(self, info, order):
-        for order_ref, sent_order in self.sent_order_dict.items():
-            if order.ref == order_ref:
-                # remove from sent list
+        # remove from sent
+        with self._state_lock:
+            self._own_orders.transition(order.ref, OrderStatus.REJECTED)
+            self._decision_scheduler.run_pending()
 
-                self.sent_order_dict[order_ref].order_status = OrderStatus(3)
-                self.sent_order_dict.pop(order.ref)
+    def _rebalance_orders(self, public_orders):
+        """
+        Orders that move holdings towards the optimal holdings given the best public bid/ ask in each market
+        Our trade will take the opposite order side of the market trade, for at most the units of that public order
+        (less the units our outstanding orders already trade against it) and the market's max units
+        :param public_orders: best public bid and ask orders (see _LocalOrderBook.best_public_orders)
+        :return: list of (market, order side, price, units)
+        """
+        no_securities = len(self._state.index)
+        buy_prices = np.full(no_securities, np.inf)
+        sell_prices = np.full(no_securities, -np.inf)
+        max_buy_units = np.zeros(no_securities, dtype=int)
+        max_sell_units = np.zeros(no_securities, dtype=int)
+        markets = {}
+
+        for order in public_orders:
+            order_index = self._state.index[order.market.item]
+            markets[order_index] = order.market
+
+            # Skip markets where no more orders can be sent, unless a queued order or a less valuable resting order
+            # can be replaced
+            trade_side = OrderSide.BUY if order.order_side == OrderSide.SELL else OrderSide.SELL
+            if self._own_orders.outstanding(order.market.item) >= order.market.max_units and \
+                    self._order_pipeline.queued_intent((order.market.item, trade_side)) is None and \
+                    self._replaceable_resting_order(order.market.item, trade_side, order.price) is None:
+                continue
+
+            order_units = max(0, order.units - self._crossing_units(order))
+            if order.order_side == OrderSide.SELL:
+                buy_prices[order_index] = order.price
+                max_buy_units[order_index] = min(order_units, order.market.max_units)
+            else:
+                sell_prices[order_index] = order.price
+                max_sell_units[order_index] = min(order_units, order.market.max_units)
+
+        # Respect the short selling limit on available units
+        max_sell_units = np.clip(np.minimum(max_sell_units, self._state.units_available + MAX_SHORT_UNITS), 0, None)
+
+        if not max_buy_units.any() and not max_sell_units.any():
+            return []
+
+        target_holdings, trade_units = self._plan_rebalance(buy_prices, sell_prices, max_buy_units, max_sell_units,
+                                                            self._state.cash_available)
+
+        rebalance_orders = []
+        for order_index in np.flatnonzero(trade_units):
+            if trade_units[order_index] > 0:
+                rebalance_orders.append((markets[order_index], OrderSide.BUY, int(buy_prices[order_index]),
+                                         int(trade_units[order_index])))
+            else:
+                rebalance_orders.append((markets[order_index], OrderSide.SELL, int(sell_prices[order_index]),
+                                         int(-trade_units[order_index])))
+
+        return rebalance_orders
+
+    def _plan_rebalance(self, buy_prices, sell_prices, max_buy_units, max_sell_units, cash_available):
+        """
+        Solve for the integer holdings that maximise E[payoff] - b * Var given the prices we can buy and sell at
+        Planning starts from the settled holdings plus the units of our orders in flight, so that orders sent by
+        earlier decision passes (which the marketplace has not accepted yet) are not sent again
+        Works by coordinate ascent: the single unit trade with the largest performance improvement is made until no
+        trade improves performance or the unit/ cash limits are reached. Each step updates Sigma x in O(n)
+        :param buy_prices: price (cents) we can buy each security at, inf if it cannot be bought
+        :param sell_prices: price (cents) we can sell each security at, -inf if it cannot be sold
+        :param max_buy_units: maximum units bought of each security
+        :param max_sell_units: maximum units sold of each security
+        :param cash_available: cash (cents) available to buy with
+        :return: (target holdings vector, units traded of each security - positive to buy, negative to sell)
+        """
+        trade_units = np.zeros(len(self._state.index), dtype=int)
+        pending_units = self._pending_units()
+        covariance_holdings = self.covariance_holdings + self._state.covariance_matrix @ pending_units
+        asset_variances = np.diag(self._state.covariance_matrix)
+        buy_costs = np.where(np.isfinite(buy_prices), buy_prices, 0)
+
+        while True:
+            # performance change of buying/ selling one more unit of each security
+            buy_deltas = self._state.mean_payoffs - buy_prices * CONVERT_TO_DOLLARS - \
+                self._risk_penalty * (2 * covariance_holdings + asset_variances)
+            sell_deltas = sell_prices * CONVERT_TO_DOLLARS - self._state.mean_payoffs - \
+                self._risk_penalty * (asset_variances - 2 * covariance_holdings)
+
+            buy_deltas[(trade_units >= max_buy_units) | (buy_costs > cash_available)] = -np.inf
+            sell_deltas[-trade_units >= max_sell_units] = -np.inf
+
+            best_buy = np.argmax(buy_deltas)
+            best_sell = np.argmax(sell_deltas)
+            if max(buy_deltas[best_buy], sell_deltas[best_sell]) <= 0:
                 break
 
-    def _take_performance_improvement(self, order_market, order_side, order_price):
+            if buy_deltas[best_buy] >= sell_deltas[best_sell]:
+                trade_units[best_buy] += 1
+                covariance_holdings += self._state.covariance_matrix[:, best_buy]
+                cash_available -= buy_prices[best_buy]
+            else:
+                trade_units[best_sell] -= 1
+                covariance_holdings -= self._state.covariance_matrix[:, best_sell]
+
+        return self._state.units + pending_units + trade_units, trade_units
+
+    def _crossing_units(self, public_order):
+        """
+        Units of our outstanding (not being cancelled) orders priced to trade against a public order
+        :param public_order:
+        :return:
+        """
+        crossing_units = 0
+        for current_order in self._own_orders.outstanding_orders(public_order.market.item):
+            if current_order.order_side == public_order.order_side or \
+                    self._own_orders.cancel_requested(current_order.ref):
+                continue
+            if current_order.order_side == OrderSide.BUY and current_order.price >= public_order.price or \
+                    current_order.order_side == OrderSide.SELL and current_order.price <= public_order.price:
+                crossing_units += current_order.units
+
+        return crossing_units
+
+    def _pending_units(self):
+        """
+        Units our orders in flight (sent, not yet accepted) would add to the settled holdings if they traded in full
+        Accepted orders are resting quotes that may never trade, so they are left out
+        :return: units vector ordered by the security index - positive for buys, negative for sells
+        """
+        pending_units = np.zeros(len(self._state.index), dtype=int)
+        for current_order in self._own_orders.orders(OrderStatus.SENT).values():
+            direction = 1 if current_order.order_side == OrderSide.BUY else -1
+            pending_units[self._state.index[current_order.trade_market_id.item]] += direction * current_order.units
+
+        return pending_units
+
+    def _take_performance_improvement(self, order_market, order_side, order_price, order_units=1):
         """
         Check if we can make the performance improving order and if we can, do so
         :param order_market:
         :param order_side:
         :param order_price:
-        :return:
+        :param order_units:
+        :return: True if the order was sent
         """
 
         # Ensure that pending units in orders do not exceed maximum units in orders allowed in a single market
-        no_outstanding_orders = 0
-        for pending_order in self.pending_order_dict.values():
-            if pending_order.trade_market_id == order_market:
-                no_outstanding_orders += 1
-
-        for sent_order in self.sent_order_dict.values():
-            if sent_order.trade_market_id == order_market:
-                no_outstanding_orders += 1
-
-        if no_outstanding_orders >= order_market.max_units:
-            return
+        # If the market is full, an order for the same market and side still queued by the rate limit is replaced by
+        # the new order when it is queued, otherwise a less valuable resting order can be cancelled and replaced
+        stale_order = None
+        if self._own_orders.outstanding(order_market.item) >= order_market.max_units and \
+                self._order_pipeline.queued_intent((order_market.item, order_side)) is None:
+            stale_order = self._replaceable_resting_order(order_market.item, order_side, order_price, order_units)
+            if stale_order is None:
+                return False
 
         # check if submit the order and if we can submit the order, do so
         if order_market.min_price <= order_price <= order_market.max_price:
             if order_side == OrderSide.BUY:
-                if self.cash_available >= order_price:
-                    new_order = _CurrentOrder(order_price, OrderSide.BUY, order_market, self)
-                    self.sent_order_dict[new_order.ref] = new_order
+                if self._state.cash_available >= order_price * order_units:
+                    self._send_current_order(_CurrentOrder(order_price, OrderSide.BUY, order_market, order_units),
+                                             stale_order)
+                    return True
                 else:
                     self.inform(f"Insufficient funds to take performance improvement")
 
             elif order_side == OrderSide.SELL:
-                if self.units_available_holdings[order_market.item] >= 0:
-                    new_order = _CurrentOrder(order_price, OrderSide.SELL, order_market, self)
-                    self.sent_order_dict[new_order.ref] = new_order
+                if self._state.available_units(order_market.item) - order_units >= -MAX_SHORT_UNITS:
+                    self._send_current_order(_CurrentOrder(order_price, OrderSide.SELL, order_market, order_units),
+                                             stale_order)
+                    return True
                 else:
                     self.inform(f"Insufficient units of "
                                 f"{order_market.item} to take performance improvement")
         else:
             self.inform(f"Order Price out of Market Price Ranges")
 
+        return False
+
+    def _send_current_order(self, current_order, replaced_order=None):
+        """
+        Track a new order and queue it for sending, after a cancel of the resting order it replaces (if any)
+        :param current_order: _CurrentOrder
+        :param replaced_order: resting Order to cancel
+        """
+        outbound_orders = []
+        if replaced_order is not None:
+            outbound_orders.append(self._cancel_order(replaced_order))
+
+        outbound_orders.append(current_order._create_order())
+        self._own_orders.add(current_order)
+        self._order_pipeline.submit((current_order.trade_market_id.item, current_order.order_side),
+                                    outbound_orders, current_order)
+
+    def _cancel_order(self, resting_order):
+        """
+        Cancel order for one of our resting orders - uses up a token of the cancel rate limit
+        :param resting_order: resting Order
+        :return: cancel Order
+        """
+        self._cancel_rate_limit.take()
+        self._own_orders.request_cancel(resting_order.ref)
+        self._metrics.count("orders_cancelled")
+
+        cancel_order = copy.copy(resting_order)
+        cancel_order.order_type = OrderType.CANCEL
+        return cancel_order
+
+    def _resting_quote_values(self, market_item=None):
+        """
+        Performance change of trading each of our resting (accepted, not being cancelled) orders in full, based off
+        the settled holdings
+        :param market_item: only orders in this market (None for every market)
+        :return: list of (performance delta, _CurrentOrder), least valuable first
+        """
+        if market_item is None:
+            resting_orders = self._own_orders.orders(OrderStatus.ACCEPTED).values()
+        else:
+            resting_orders = self._own_orders.outstanding_orders(market_item)
+
+        resting_orders = [current_order for current_order in resting_orders
+                          if current_order.order_status == OrderStatus.ACCEPTED and
+                          not self._own_orders.cancel_requested(current_order.ref)]
+        if not resting_orders:
+            return []
+
+        no_orders = len(resting_orders)
+        asset_indices = np.fromiter((self._state.index[current_order.trade_market_id.item]
+                                     for current_order in resting_orders), dtype=int, count=no_orders)
+        directions = np.fromiter((1 if current_order.order_side == OrderSide.BUY else -1
+                                  for current_order in resting_orders), dtype=float, count=no_orders)
+        prices = np.fromiter((current_order.price for current_order in resting_orders), dtype=float, count=no_orders)
+        units = np.fromiter((current_order.units for current_order in resting_orders), dtype=float, count=no_orders)
+
+        performance_deltas = self._performance_deltas(asset_indices, directions, prices, units)
+        self._metrics.count("performance_evaluations", no_orders)
+
+        return [(performance_deltas[order_index], resting_orders[order_index])
+                for order_index in np.argsort(performance_deltas, kind="stable")]
+
+    def _replaceable_resting_order(self, market_item, order_side, order_price, order_units=1):
+        """
+        Find our least valuable resting order in a market, if it is worth less than a new order (capacity goes to the
+        most valuable quotes) and the cancel rate limit allows it to be cancelled
+        :param market_item:
+        :param order_side: side of the new order
+        :param order_price: price of the new order
+        :param order_units: units of the new order
+        :return: resting Order, or None
+        """
+        if not self._cancel_rate_limit.available():
+            return None
+
+        quote_values = self._resting_quote_values(market_item)
+        if not quote_values:
+            return None
+
+        new_order_value = self._performance_deltas(self._state.index[market_item],
+                                                   1 if order_side == OrderSide.BUY else -1, order_price, order_units)
+        resting_order_value, resting_current_order = quote_values[0]
+        if resting_order_value > 0 and resting_order_value >= new_order_value:
+            return None
+
+        return self._order_book.get(resting_current_order.ref)
+
+    def _manage_quotes(self):
+        """
+        Re-score our resting orders against the settled holdings, and cancel those that no longer improve
+        performance (most harmful first, as far as the cancel rate limit allows). Cancelled orders are repriced at the
+        closest performance improving price, if there is one
+        """
+        for resting_order_value, resting_current_order in self._resting_quote_values():
+            if resting_order_value > 0 or not self._cancel_rate_limit.available():
+                break
+
+            resting_order = self._order_book.get(resting_current_order.ref)
+            if resting_order is None:
+                continue
+
+            market = resting_current_order.trade_market_id
+            market_id = self._index_market_ids[self._state.index[market.item]]
+            best_prices = self._get_best_bid_ask_price(market_id, market.item)
+            order_price = self._reservation_price_search(market_id, best_prices, resting_current_order.order_side,
+                                                         resting_current_order.units)
+
+            if order_price is None:
+                self._order_pipeline.submit((market.item, resting_current_order.order_side),
+                                            [self._cancel_order(resting_order)])
+            else:
+                self._metrics.count("orders_repriced")
+                self._send_current_order(_CurrentOrder(order_price, resting_current_order.order_side, market,
+                                                       resting_current_order.units), resting_order)
+
+    def _order_dropped(self, current_order):
+        """
+        Called by the order pipeline when a queued order is replaced by a newer order before it was sent
+        :param current_order: None for cancels
+        """
+        if current_order is not None:
+            self._own_orders.transition(current_order.ref, OrderStatus.CANCELLED)
+
+    def _own_order_changed(self, current_order):
+        """
+        Called by the own order tracker whenever one of our orders is added or changes status
+        :param current_order:
+        """
+        if self._journal is not None:
+            self._journal.record_own_order(current_order)
+
     def received_orders(self, orders: List[Order]):
-        # Bot in Reactive Mode
-        portfolio_optimal_flag = self.is_portfolio_optimal()
+        with self._state_lock, self._metrics.timer("received_orders"):
+            # Seed the local order book with every known order the first time, then only apply the updates
+            if not self._order_book_seeded:
+                orders = list(Order.all().values()) + list(orders)
+                self._order_book_seeded = True
 
-        # Bot in Proactive Mode
-        if portfolio_optimal_flag:
-            self._proactive_mode()
+            if self._journal is not None:
+                self._journal.record_orders(orders)
 
-    def _proactive_mode(self):
+            self._metrics.count("order_updates", len(orders))
+            for order in orders:
+                self._order_book.update(order)
+
+                # update my order statuses
+                if order.mine:
+                    self._update_trade_status(order)
+
+            # Run the decision pass now, or coalesce these updates into the next one
+            self._decision_scheduler.notify(len(orders))
+
+        self._metrics.maybe_dump()
+
+    def _decision_pass(self):
         """
-        If portfolio is optimal => Switch bot to Proactive Mode (find our own performance improving orders)
-        Code is only run when there are no reactive performance improving opportunities
+        Reactive then (if the portfolio is optimal) proactive mode, run on the latest order book and holdings
         """
+        evaluations_before = self._metrics.counter("performance_evaluations")
 
-        # Randomly pick an asset market
-        random_asset_market = random.choice(list(self._market_ids.keys()))
-        random_asset_item = self._market_ids[random_asset_market].item
+        with self._metrics.timer("decision_pass"):
+            # Bot in Reactive Mode
+            portfolio_optimal_flag = self.is_portfolio_optimal()
 
-        # Get best bid and ask prices for that random asset market
-        best_prices = self._get_best_bid_ask_price(random_asset_market, random_asset_item)
+            # Bot in Proactive Mode
+            if portfolio_optimal_flag:
+                self._proactive_mode()
 
-        # Determine the Order Side of Trade
-        # If we are running low on Cash => Try to sell/ short sell asset to gain funds
-        if self.cash_available < best_prices["best_ask"]:
-            order_direction = OrderSide.SELL
+        self._order_pipeline.flush()
+        self._metrics.observe("evaluations_per_decision",
+                              self._metrics.counter("performance_evaluations") - evaluations_before)
 
-        # Otherwise, pick a random order side
-        else:
-            order_direction = random.choice(list([OrderSide.BUY, OrderSide.SELL]))
+    def _proactive_mode(self):
+        """
+        If portfolio is optimal => Switch bot to Proactive Mode (find our own performance improving orders)
+        Code is only run when there are no reactive performance improving opportunities
+        """
 
-        # Run gradient price search
-        self._gradient_price_search(random_asset_market, best_prices, order_direction)
+        with self._metrics.timer("proactive_mode"):
+            # Rank every (market, side) by the improvement of quoting at its closest performance improving price,
+            # and quote the best opportunities first
+            orders_sent = 0
+            for performance_delta, market_id, order_direction, order_price in self._rank_proactive_opportunities():
+                if orders_sent >= self._proactive_orders:
+                    return
+                if self._take_performance_improvement(self._market_ids[market_id], order_direction, order_price):
+                    orders_sent += 1
+
+    def _rank_proactive_opportunities(self):
+        """
+        Closest performance improving quote price for every market and side, with the performance improvement of
+        trading one unit at that price, computed from the best bid/ ask and reservation prices in one pass
+        :return: list of (performance delta, market id, order side, price) for improving quotes, best first
+        """
+        best_bids = np.empty(len(self._index_market_ids))
+        best_asks = np.empty(len(self._index_market_ids))
+        for order_index, market_id in enumerate(self._index_market_ids):
+            best_prices = self._get_best_bid_ask_price(market_id, self._market_ids[market_id].item)
+            best_bids[order_index] = best_prices["best_bid"]
+            best_asks[order_index] = best_prices["best_ask"]
+
+        self._metrics.count("price_search_steps", 2 * len(best_bids))
+
+        # Step down from the best bid to below the reservation bid/ up from the best ask to above the reservation ask
+        bid_steps = np.where(best_bids < self.reservation_bids, 0,
+                             np.floor((best_bids - self.reservation_bids) / self._market_price_ticks) + 1)
+        ask_steps = np.where(best_asks > self.reservation_asks, 0,
+                             np.floor((self.reservation_asks - best_asks) / self._market_price_ticks) + 1)
+        buy_prices = best_bids - bid_steps * self._market_price_ticks
+        sell_prices = best_asks + ask_steps * self._market_price_ticks
+
+        asset_indices = np.arange(len(best_bids))
+        performance_deltas = np.concatenate((
+            self._performance_deltas(asset_indices, 1, buy_prices),
+            self._performance_deltas(asset_indices, -1, sell_prices)))
+        self._metrics.count("performance_evaluations", len(performance_deltas))
+
+        # Quotes must be within the market price range, and affordable/ within the short selling limit
+        units_available = self._state.units_available
+        quote_prices = np.concatenate((buy_prices, sell_prices))
+        valid_quotes = np.concatenate((
+            buy_prices <= self._state.cash_available,
+            units_available - 1 >= -MAX_SHORT_UNITS))
+        valid_quotes &= (np.tile(self._market_min_prices, 2) <= quote_prices) & \
+            (quote_prices <= np.tile(self._market_max_prices, 2))
+
+        opportunities = []
+        for quote_index in np.argsort(-performance_deltas, kind="stable"):
+            if performance_deltas[quote_index] <= 0:
+                break
+            if valid_quotes[quote_index]:
+                order_index = quote_index % len(best_bids)
+                order_direction = OrderSide.BUY if quote_index < len(best_bids) else OrderSide.SELL
+                opportunities.append((performance_deltas[quote_index], self._index_market_ids[order_index],
+                                      order_direction, int(quote_prices[quote_index])))
 
-    def _gradient_price_search(self, market_id, best_price, order_side):
+        return opportunities
+
+    def _reservation_price_search(self, market_id, best_price, order_side, units=1):
         """
-        Search for an order price in a given market and order side that would improve portfolio performance
+        Find the order price closest to the best bid/ ask in a given market and order side that would improve
+        portfolio performance, using the closed form reservation price instead of stepping through every price tick
         :param market_id:
         :param best_price:
         :param order_side:
-        :return:
+        :param units: number of units quoted
+        :return: order price, or None if no price within the market price range improves performance
         """
 
-        # Get market max, min price and gradient ascent/ descent price step
+        # Get market max, min price and price step
         max_price = self._market_ids[market_id].max_price
         min_price = self._market_ids[market_id].min_price
         price_step = self._market_ids[market_id].price_tick
+        item_index = self._state.index[self._market_ids[market_id].item]
 
-        self.current_performance = self._calculate_current_performance()
+        self._metrics.count("price_search_steps")
+        if units == 1:
+            reservation_bids, reservation_asks = self.reservation_bids, self.reservation_asks
+        else:
+            reservation_bids, reservation_asks = self._reservation_prices(units)
 
-        # Based off order side => determine if it is price ascent/ descent search and where to start price search
+        # Buying improves performance strictly below the reservation bid => step down from the best bid
         if order_side == OrderSide.BUY:
-            price_movement = -1
             price = best_price["best_bid"]
+            reservation_price = reservation_bids[item_index]
+            if price >= reservation_price:
+                price -= (math.floor((price - reservation_price) / price_step) + 1) * price_step
+
+        # Selling improves performance strictly above the reservation ask => step up from the best ask
         else:
-            price_movement = 1
             price = best_price["best_ask"]
+            reservation_price = reservation_asks[item_index]
+            if price <= reservation_price:
+                price += (math.floor((reservation_price - price) / price_step) + 1) * price_step
 
-        # ensure price search occurs within max and min price
-        while min_price <= price <= max_price:
+        # ensure price occurs within max and min price
+        if min_price <= price <= max_price:
+            return price
 
-            potential_performance = self._calculate_current_performance(True, self._market_ids[market_id].item, price,
-                                                                        order_side)
+        return None
 
-            # if this price improves performance, trade this order at this price
-            if potential_performance > self.current_performance:
-
-                self._take_performance_improvement(self._market_ids[market_id], order_side, price)
-                break
+    def _reservation_prices(self, units=1):
+        """
+        Reservation (breakeven) bid and ask prices for every market, based off settled holdings
+        Buying k units at a price below the bid or selling k units at a price above the ask improves performance:
+        bid = mu_i - b * (2 * (Sigma x)_i + k * Sigma_ii), ask = mu_i - b * (2 * (Sigma x)_i - k * Sigma_ii)
+        :param units: number of units quoted, either a scalar or a vector ordered by the security index
+        :return: arrays of reservation bid and ask prices in cents, ordered by the security index
+        """
+        marginal_payoffs = self._state.mean_payoffs - 2 * self._risk_penalty * self.covariance_holdings
+        unit_risk = self._risk_penalty * np.asarray(units) * np.diag(self._state.covariance_matrix)
 
-            # increment/ decrement price
-            price = price + (price_movement * price_step)
+        return (marginal_payoffs - unit_risk) / CONVERT_TO_DOLLARS, (marginal_payoffs + unit_risk) / CONVERT_TO_DOLLARS
 
     def _get_best_bid_ask_price(self, asset_market, asset_item):
         """
@@ -339,12 +835,13 @@ class CAPMBot(Agent):
         best_prices = {"best_bid": best_bid, "best_ask": best_ask}
 
         # Get best bid and ask prices
-        for order_id, order in Order.all().items():
-            if order.is_pending and order.market.item == asset_item:
-                if order.order_side == OrderSide.BUY and order.price > best_prices["best_bid"]:
-                    best_prices["best_bid"] = order.price
-                elif order.order_side == OrderSide.SELL and order.price < best_prices["best_ask"]:
-                    best_prices["best_ask"] = order.price
+        book_best_bid, book_best_ask = self._order_book.best_bid_ask(asset_item)
+
+        if book_best_bid is not None and book_best_bid.price > best_prices["best_bid"]:
+            best_prices["best_bid"] = book_best_bid.price
+
+        if book_best_ask is not None and book_best_ask.price < best_prices["best_ask"]:
+            best_prices["best_ask"] = book_best_ask.price
 
         # If there is no existing bids for the order side => return midpoint price
         if best_prices["best_bid"] == self._market_ids[asset_market].min_price:
@@ -375,103 +872,616 @@ class CAPMBot(Agent):
         :return:
         """
 
-        # update pending order dictionary
-        for order_ref, pending_order in self.pending_order_dict.items():
-            # order cancelled
-            if order.ref == order_ref and order.is_cancelled and order.mine:
-                # remove from pending list
+        # order cancelled
+        if order.is_cancelled:
+            self._own_orders.transition(order.ref, OrderStatus.CANCELLED)
 
-                self.pending_order_dict[order_ref].order_status = OrderStatus(4)
-                self.pending_order_dict.pop(order.ref)
-                break
-
-            # order traded
-            elif order.ref == order_ref and order.traded_order is not None and order.mine:
-                # remove from pending list and transfer to traded list
+        # order traded in full
+        elif order.traded_order is not None and not order.is_pending:
+            self._own_orders.transition(order.ref, OrderStatus.TRADED)
 
-                self.pending_order_dict[order_ref].order_status = OrderStatus(2)
-                self.traded_order_dict[order.ref] = self.pending_order_dict[order_ref]
-                self.pending_order_dict.pop(order.ref)
-                break
+        # order partly traded => the remaining units are still resting (and count towards the market's order limit)
+        elif order.is_pending:
+            self._own_orders.update_units(order.ref, order.units)
 
     def received_session_info(self, session: Session):
-        if session.is_open:
-            # self.inform("Market is open")
+        with self._state_lock:
+            if self._journal is not None:
+                self._journal.record_session(session.is_open)
 
-            # reset all variables between sessions
-            self.cash_available = None
-            self.cash = None
-            self.units_available_holdings = {}
-            self.units_holdings = {}
+            if session.is_open:
+                # self.inform("Market is open")
 
-            self.current_performance = None
-            self.potential_performance = None
+                # reset all variables between sessions - orders still queued were decided in the previous session
+                self._decision_scheduler.cancel()
+                self._order_pipeline.clear()
+                self._state.reset_holdings()
+                self._refresh_holdings_vector()
 
-            self.sent_order_dict = {}
-            self.pending_order_dict = {}
-            self.traded_order_dict = {}
+                self._own_orders = _OwnOrderTracker(self._own_order_changed)
 
-            # If payoffs have changed while market was closed => recalculate variance/ payoffs
-            recalculation_required = False
+                self._order_book = _LocalOrderBook()
+                self._order_book_seeded = False
 
-            for market_id, market_info in self.markets.items():
-                security = market_info.item
-                description = market_info.description
-                new_payoffs = [int(a) for a in description.split(",")]
+                # If payoffs have changed while market was closed => recalculate variance/ payoffs of those securities
+                changed_indices = self._refresh_payoffs()
 
-                if not np.array_equal(self._payoffs[security], new_payoffs):
-                    self._payoffs[security] = new_payoffs
-                    recalculation_required = True
+                if changed_indices:
+                    self._update_payoffs_and_variance(changed_indices)
+                    self.inform("Bot reinitialised, I have the payoffs for the states.")
 
-            if recalculation_required:
-                self._pre_calculate_payoffs_and_variance()
-                self.inform("Bot reinitialised, I have the payoffs for the states.")
-
-        elif session.is_closed:
-            # self.inform("Market is closed")
-            pass
+            elif session.is_closed:
+                # self.inform("Market is closed")
+                self._decision_scheduler.cancel()
+                self._order_pipeline.clear()
 
     def _pre_calculate_payoffs_and_variance(self):
         """
         Asset Variances, Covariances and Unit Asset Payoffs can be computed as soon as payoffs in different
         states is known. Hence, we can pre-compute these values to speed up calculation of portfolio performance.
         """
-        self.unit_asset_payoffs = {}
-        self.asset_variances = {}
-        self.asset_covariances = {}
+        state = self._state
+
+        # Pre-Calculate Payoff Matrix in Dollars (securities x states), Mean Payoff Vector and Full Covariance Matrix
+        # Use the shared statistics (and their security order) instead if they were computed from these payoffs - no
+        # private payoff matrix is kept then, as the shared statistics are never updated in place
+        shared_statistics = self._matching_shared_statistics()
+        if shared_statistics is None:
+            state.payoff_matrix = (state.payoffs * CONVERT_TO_DOLLARS).astype(self._statistics_dtype)
+            state.mean_payoffs, state.covariance_matrix = weighted_statistics(state.payoff_matrix, state.probabilities,
+                                                                              self._statistics_dtype)
+        else:
+            shared_securities, shared_mean_payoffs, shared_covariance_matrix = shared_statistics
+            state.reorder(shared_securities)
+            state.payoff_matrix = None
+            state.mean_payoffs, state.covariance_matrix = shared_mean_payoffs, shared_covariance_matrix
+
+        self._refresh_holdings_vector()
+
+        # Market ids and price ranges in security index order
+        item_market_ids = {market_info.item: market_id for market_id, market_info in self._market_ids.items()}
+        self._index_market_ids = [item_market_ids[security] for security in self._state.index]
+        self._market_min_prices = np.array([self._market_ids[market_id].min_price
+                                            for market_id in self._index_market_ids], dtype=float)
+        self._market_max_prices = np.array([self._market_ids[market_id].max_price
+                                            for market_id in self._index_market_ids], dtype=float)
+        self._market_price_ticks = np.array([self._market_ids[market_id].price_tick
+                                             for market_id in self._index_market_ids], dtype=float)
 
-        # Convert Payoffs into Dollars
-        payoff_dollars = {}
-        for security, payoff in self._payoffs.items():
-            payoff_dollars[security] = (np.array(payoff) * CONVERT_TO_DOLLARS).tolist()
+        # Print Unit Asset Payoffs, Asset Variance and Asset Covariances
+        # self.inform(f"Unit Asset Payoffs: {state.mean_payoffs}")
+        # self.inform(f"Asset Variance: {np.diag(state.covariance_matrix)}")
+        # self.inform(f"Asset Covariance: {state.covariance_matrix}")
 
-        # Pre-Calculate Unit Asset Payoffs and Asset Variance
-        for security in self._payoffs.keys():
-            self.unit_asset_payoffs[security] = np.sum(payoff_dollars[security]) * STATE_PROBABILITY
-            self.asset_variances[security] = np.var(payoff_dollars[security])
+    def _refresh_payoffs(self):
+        """
+        Re-read the market descriptions - only descriptions that changed since they were last read are parsed, but the
+        state probabilities are resolved again from every description whenever any of them changed
+        If the number of states changed, the payoffs of every security are replaced
+        :return: security indices whose payoffs changed (every security if the state probabilities or the number of
+                 states changed)
+        """
+        changed_payoffs = {}
+        for market_id, market_info in self.markets.items():
+            security = market_info.item
+            description = market_info.description
+            if self._market_descriptions.get(security) == description:
+                continue
 
-        # Pre-Calculate Co-Variances
-        all_cov_comb = permutations(payoff_dollars.keys(), 2)
+            self._market_descriptions[security] = description
+            changed_payoffs[security], self._described_probabilities[security] = parse_description(description)
 
-        for security_comb in all_cov_comb:
-            cov_pair = np.cov(payoff_dollars[security_comb[0]], payoff_dollars[security_comb[1]], bias=True)[0][1]
-            self.asset_covariances[security_comb] = cov_pair
+        if not changed_payoffs:
+            return []
 
-        # Print Unit Asset Payoffs, Asset Variance and Asset Covariances
-        # self.inform(f"Unit Asset Payoffs: {self.unit_asset_payoffs}")
-        # self.inform(f"Asset Variance: {self.asset_variances}")
-        # self.inform(f"Asset Covariance: {self.asset_covariances}")
+        state = self._state
+        if any(len(security_payoffs) != state.payoffs.shape[1] for security_payoffs in changed_payoffs.values()):
+            payoffs = [changed_payoffs.get(security, state.payoffs[security_index].tolist())
+                       for security_index, security in enumerate(state.securities)]
+            if len({len(security_payoffs) for security_payoffs in payoffs}) > 1:
+                raise ValueError("Market descriptions give different numbers of states")
+
+            state.set_payoffs(state.securities, payoffs)
+            changed_indices = list(range(len(state.securities)))
+        else:
+            changed_indices = [state.index[security] for security, security_payoffs in changed_payoffs.items()
+                               if state.update_payoffs(security, security_payoffs)]
+
+        probabilities = self._resolve_state_probabilities()
+        if len(probabilities) != len(state.probabilities) or not np.array_equal(probabilities, state.probabilities):
+            state.probabilities = probabilities
+            changed_indices = list(range(len(state.securities)))
+
+        return changed_indices
+
+    def _update_payoffs_and_variance(self, changed_indices):
+        """
+        Re-calculate the payoff statistics after the payoffs of some securities changed
+        Only the mean payoffs and the covariance matrix rows/ columns of those securities are re-calculated, in one
+        matrix product: Sigma[C, :] = (P[C] - mu[C]) diag(p) (P - mu)^T
+        The statistics arrays are replaced by updated copies rather than modified, so state snapshots can share them
+        :param changed_indices: security indices whose payoffs changed
+        """
+        state = self._state
+
+        # Shared statistics are never modified - re-check them against the new payoffs (copying on write)
+        if state.payoff_matrix is None or state.covariance_matrix is None or \
+                len(changed_indices) == len(state.securities):
+            self._pre_calculate_payoffs_and_variance()
+            return
+
+        changed_indices = np.asarray(changed_indices)
+        payoff_matrix = state.payoff_matrix.copy()
+        mean_payoffs = state.mean_payoffs.copy()
+        covariance_matrix = state.covariance_matrix.copy()
+
+        payoff_matrix[changed_indices] = state.payoffs[changed_indices] * CONVERT_TO_DOLLARS
+        mean_payoffs[changed_indices] = weighted_mean(payoff_matrix[changed_indices], state.probabilities,
+                                                      self._statistics_dtype)
+
+        changed_covariances = weighted_covariance_rows(payoff_matrix, mean_payoffs, state.probabilities,
+                                                       changed_indices, self._statistics_dtype)
+        covariance_matrix[changed_indices, :] = changed_covariances
+        covariance_matrix[:, changed_indices] = changed_covariances.T
+
+        state.payoff_matrix = payoff_matrix
+        state.mean_payoffs = mean_payoffs
+        state.covariance_matrix = covariance_matrix
+
+        self._refresh_holdings_vector()
+
+    def _matching_shared_statistics(self):
+        """
+        Shared payoff statistics, if they were given and were computed from the current payoffs of every market and
+        the current state probabilities
+        :return: (securities, mean payoffs, covariance matrix), or None
+        """
+        if self._shared_statistics is None:
+            return None
+
+        shared_securities, shared_payoffs, shared_probabilities, shared_mean_payoffs, shared_covariance_matrix = \
+            self._shared_statistics
+        if sorted(shared_securities) != sorted(self._state.securities) or \
+                shared_payoffs.shape != self._state.payoffs.shape or \
+                not np.allclose(shared_probabilities, self._state.probabilities):
+            return None
+
+        payoffs = self._state.payoffs[[self._state.index[security] for security in shared_securities]]
+        if not np.array_equal(shared_payoffs, payoffs):
+            return None
+
+        return list(shared_securities), shared_mean_payoffs, shared_covariance_matrix
 
     def pre_start_tasks(self):
         self._pre_calculate_payoffs_and_variance()
+        self.execute_periodically(self._periodic_task,
+                                  max(self._decision_scheduler.min_interval, PERIODIC_TASK_INTERVAL))
+        # Orders held back by the rate limit are sent as soon as it allows, however long the decision interval
+        self.execute_periodically(self._order_pipeline.flush, PERIODIC_TASK_INTERVAL)
+
+    def _periodic_task(self):
+        """
+        Run periodically on the client's callback thread, between callbacks - acts on the latest state once a burst
+        of order updates has drained, even if no further callback arrives
+        """
+        with self._state_lock:
+            self._decision_scheduler.run_pending()
 
     def received_holdings(self, holdings):
+        with self._state_lock, self._metrics.timer("received_holdings"):
+            if self._journal is not None:
+                self._journal.record_holdings(holdings)
+
+            units_changed = self._state.update_holdings(holdings)
+
+            # Refresh the cached Sigma x term and reservation prices used for performance deltas and quote prices -
+            # only when settled units change (they do not depend on cash, or on available cash/ units)
+            if units_changed:
+                self._refresh_holdings_vector()
+
+                # Resting orders priced for the previous holdings may no longer improve performance
+                self._manage_quotes()
+
+            # Run a decision pass held back by the decision interval
+            self._decision_scheduler.run_pending()
+
+        self._order_pipeline.flush()
+
+    def _refresh_holdings_vector(self):
+        """
+        Rebuild the cached Sigma x term and reservation prices from the settled holdings vector
+        This is the only state derived from the holdings - it must be refreshed whenever settled units change (or
+        payoffs are re-calculated)
+        """
+        if self._state.covariance_matrix is None:
+            return
+
+        self.covariance_holdings = self._state.covariance_matrix @ self._state.units
+        self.reservation_bids, self.reservation_asks = self._reservation_prices()
+
+
+class _PortfolioState:
+    """
+    Payoffs, payoff statistics and holdings of every security in contiguous arrays, ordered by a stable security index
+    Holdings are filled in place as they are received, so no dicts keyed by security are rebuilt in the hot path
+    """
+    def __init__(self):
+        self.securities = []
+        self.index = {}
+
+        # Payoffs in cents and dollars (securities x states), state probabilities, mean payoffs and the covariance
+        # matrix of payoffs - there is no payoff matrix in dollars while the statistics are shared between bots
+        self.payoffs = np.zeros((0, 0), dtype=np.int64)
+        self.probabilities = None
+        self.payoff_matrix = None
+        self.mean_payoffs = None
+        self.covariance_matrix = None
+
+        # Settled and available units, and settled and available cash (cents)
+        self.units = np.zeros(0, dtype=np.int64)
+        self.units_available = np.zeros(0, dtype=np.int64)
+        self.cash = None
+        self.cash_available = None
+
+    def set_payoffs(self, securities, payoffs):
+        """
+        Set the securities traded and their payoffs, keeping the holdings of securities that are still traded
+        :param securities: list of securities
+        :param payoffs: payoffs (cents) in each state, in the same order as securities
+        """
+        units = self.units_dict()
+        units_available = self.units_available_dict()
+
+        self.securities = list(securities)
+        self.index = {security: index for index, security in enumerate(self.securities)}
+        self.payoffs = np.array(payoffs, dtype=np.int64).reshape(len(self.securities), -1)
+        self.units = np.array([units.get(security, 0) for security in self.securities], dtype=np.int64)
+        self.units_available = np.array([units_available.get(security, 0) for security in self.securities],
+                                        dtype=np.int64)
+
+    def update_payoffs(self, security, payoffs):
+        """
+        Update the payoffs of a single security in place (statistics must be re-calculated afterwards)
+        :param security:
+        :param payoffs: payoffs (cents) in each state
+        :return: True if the payoffs changed
+        """
+        security_index = self.index[security]
+        if np.array_equal(self.payoffs[security_index], payoffs):
+            return False
+
+        self.payoffs[security_index] = payoffs
+        return True
+
+    def reorder(self, securities):
+        """
+        Re-index every per security array to a new order of the same securities
+        :param securities:
+        """
+        if list(securities) == self.securities:
+            return
+
+        order = [self.index[security] for security in securities]
+        self.securities = list(securities)
+        self.index = {security: index for index, security in enumerate(self.securities)}
+        self.payoffs = self.payoffs[order]
+        self.units = self.units[order]
+        self.units_available = self.units_available[order]
+        for statistic in ("payoff_matrix", "mean_payoffs"):
+            if getattr(self, statistic) is not None:
+                setattr(self, statistic, getattr(self, statistic)[order])
+        if self.covariance_matrix is not None:
+            self.covariance_matrix = self.covariance_matrix[np.ix_(order, order)]
+
+    def reset_holdings(self):
+        self.units.fill(0)
+        self.units_available.fill(0)
+        self.cash = None
+        self.cash_available = None
+
+    def update_holdings(self, holdings):
+        """
+        Fill in the received holdings in place
+        :param holdings: holdings passed to received_holdings
+        :return: True if the settled units changed
+        """
+        units_changed = False
+
         self.cash = holdings.cash
         self.cash_available = holdings.cash_available
 
-        for market_id, asset in holdings.assets.items():
-            self.units_available_holdings[market_id.item] = asset.units_available
-            self.units_holdings[market_id.item] = asset.units
+        for market, asset in holdings.assets.items():
+            security_index = self.index.get(market.item)
+            if security_index is None:
+                continue
+
+            self.units_available[security_index] = asset.units_available
+            if self.units[security_index] != asset.units:
+                self.units[security_index] = asset.units
+                units_changed = True
+
+        return units_changed
+
+    def available_units(self, security):
+        return int(self.units_available[self.index[security]])
+
+    def units_dict(self):
+        return dict(zip(self.securities, self.units.tolist()))
+
+    def units_available_dict(self):
+        return dict(zip(self.securities, self.units_available.tolist()))
+
+    def snapshot(self):
+        """
+        Copy of the state (payoff statistics are shared, as they are replaced rather than modified - see
+        CAPMBot._update_payoffs_and_variance)
+        :return: _PortfolioState
+        """
+        state = copy.copy(self)
+        state.securities = list(self.securities)
+        state.index = dict(self.index)
+        state.payoffs = self.payoffs.copy()
+        state.units = self.units.copy()
+        state.units_available = self.units_available.copy()
+        return state
+
+
+class _OrderBookSide:
+    """
+    Resting orders on one side of one market
+    Orders are kept in a price-sorted heap with lazy removal, so the best order is found in O(1) (amortised)
+    and orders are inserted/ removed in O(log n). The heap is rebuilt from the live orders once stale entries
+    outnumber them, so it stays within twice the size of the book side
+    """
+    __slots__ = ("_heap", "_orders", "_price_sign", "_sequence")
+
+    def __init__(self, order_side):
+        self._heap = []
+        self._orders = {}
+
+        # Bids are stored with negated prices so that the heap top is always the best price
+        self._price_sign = -1 if order_side == OrderSide.BUY else 1
+        self._sequence = 0
+
+    def add(self, order_key, order):
+        self._sequence += 1
+        self._orders[order_key] = (self._sequence, order)
+        heapq.heappush(self._heap, (self._price_sign * order.price, self._sequence, order_key))
+
+    def remove(self, order_key):
+        # stale heap entries are discarded when they reach the top of the heap, or when the heap is compacted
+        if self._orders.pop(order_key, None) is not None and len(self._heap) > 2 * len(self._orders):
+            self._compact()
+
+    def _compact(self):
+        self._heap = [(self._price_sign * order.price, sequence, order_key)
+                      for order_key, (sequence, order) in self._orders.items()]
+        heapq.heapify(self._heap)
+
+    def best(self):
+        while self._heap:
+            price, sequence, order_key = self._heap[0]
+            entry = self._orders.get(order_key)
+            if entry is not None and entry[0] == sequence:
+                return entry[1]
+            heapq.heappop(self._heap)
+
+        return None
+
+    def __len__(self):
+        return len(self._orders)
+
+
+class _LocalOrderBook:
+    """
+    Local copy of the pending orders in every market, keyed by security
+    Public and own orders are kept on separate book sides so the best public price can be found without skipping
+    our own orders. Orders can be looked up by their fm id or ref in O(1)
+    """
+    def __init__(self):
+        self._book_sides = {}
+        self._orders = {}
+        self._order_refs = {}
+
+    def update(self, order):
+        """
+        Apply an order update - pending orders are inserted (or replaced), all other orders are removed
+        :param order:
+        """
+        self.remove(order.fm_id)
+
+        if order.is_pending:
+            book_side = self._book_side(order.market.item, order.order_side, order.mine)
+            book_side.add(order.fm_id, order)
+            self._orders[order.fm_id] = (order, book_side)
+
+            if order.ref is not None:
+                self._order_refs[order.ref] = order
+
+    def remove(self, order_key):
+        entry = self._orders.pop(order_key, None)
+        if entry is None:
+            return
+
+        order, book_side = entry
+        book_side.remove(order_key)
+        if order.ref is not None and self._order_refs.get(order.ref) is order:
+            self._order_refs.pop(order.ref)
+
+    def get(self, order_ref):
+        """
+        Get a pending order by its ref
+        :param order_ref:
+        :return: order, or None if the order is not pending
+        """
+        return self._order_refs.get(order_ref)
+
+    def best_bid_ask(self, item, include_mine=True):
+        """
+        Best pending bid and ask orders for a security
+        :param item:
+        :param include_mine: include our own orders
+        :return: (best bid order, best ask order) - either may be None
+        """
+        best_orders = []
+        for order_side in (OrderSide.BUY, OrderSide.SELL):
+            candidates = [self._book_side(item, order_side, False).best()]
+            if include_mine:
+                candidates.append(self._book_side(item, order_side, True).best())
+
+            candidates = [order for order in candidates if order is not None]
+            if not candidates:
+                best_orders.append(None)
+            elif order_side == OrderSide.BUY:
+                best_orders.append(max(candidates, key=lambda order: order.price))
+            else:
+                best_orders.append(min(candidates, key=lambda order: order.price))
+
+        return tuple(best_orders)
+
+    def best_public_orders(self):
+        """
+        Best public (not mine) bid and ask order in every market
+        :return: list of orders
+        """
+        best_orders = []
+        for (item, order_side, mine), book_side in self._book_sides.items():
+            if not mine:
+                best_order = book_side.best()
+                if best_order is not None:
+                    best_orders.append(best_order)
+
+        return best_orders
+
+    def _book_side(self, item, order_side, mine):
+        book_side_key = (item, order_side, mine)
+        book_side = self._book_sides.get(book_side_key)
+        if book_side is None:
+            book_side = self._book_sides[book_side_key] = _OrderBookSide(order_side)
+
+        return book_side
+
+    def __len__(self):
+        return len(self._orders)
+
+
+class _OwnOrderTracker:
+    """
+    State machine for our own orders, keyed by order ref
+    Every state transition is a direct ref lookup, and the outstanding (sent or accepted) orders in each market are
+    kept up to date on each transition so that the per-market order limit can be checked in O(1)
+    """
+    _TRANSITIONS = {
+        OrderStatus.SENT: {OrderStatus.ACCEPTED, OrderStatus.REJECTED, OrderStatus.TRADED, OrderStatus.CANCELLED},
+        OrderStatus.ACCEPTED: {OrderStatus.TRADED, OrderStatus.CANCELLED},
+    }
+    _OUTSTANDING = {OrderStatus.SENT, OrderStatus.ACCEPTED}
+
+    # Orders in these states are forgotten rather than kept
+    _DISCARDED = {OrderStatus.REJECTED, OrderStatus.CANCELLED}
+
+    def __init__(self, on_change=None):
+        """
+        :param on_change: called with each order when it is added or its status changes
+        """
+        self._on_change = on_change
+        self._orders = {}
+        self._orders_by_status = {order_status: {} for order_status in OrderStatus}
+        self._outstanding = {}
+        self._cancel_requests = set()
+
+    def add(self, current_order):
+        """
+        Track a newly sent order
+        :param current_order: _CurrentOrder
+        """
+        current_order.order_status = OrderStatus.SENT
+        self._orders[current_order.ref] = current_order
+        self._orders_by_status[OrderStatus.SENT][current_order.ref] = current_order
+
+        self._outstanding.setdefault(current_order.trade_market_id.item, {})[current_order.ref] = current_order
+        if self._on_change is not None:
+            self._on_change(current_order)
+
+    def transition(self, order_ref, order_status):
+        """
+        Move an order to a new status - unknown refs and out of order messages (e.g. an accept arriving after the
+        order has already traded) are ignored
+        :param order_ref:
+        :param order_status:
+        :return: the order if its status changed, None otherwise
+        """
+        current_order = self._orders.get(order_ref)
+        if current_order is None or order_status not in self._TRANSITIONS.get(current_order.order_status, ()):
+            return None
+
+        self._orders_by_status[current_order.order_status].pop(order_ref)
+        if current_order.order_status in self._OUTSTANDING and order_status not in self._OUTSTANDING:
+            self._outstanding[current_order.trade_market_id.item].pop(order_ref)
+            self._cancel_requests.discard(order_ref)
+
+        current_order.order_status = order_status
+        if order_status in self._DISCARDED:
+            self._orders.pop(order_ref)
+        else:
+            self._orders_by_status[order_status][order_ref] = current_order
+
+        if self._on_change is not None:
+            self._on_change(current_order)
+        return current_order
+
+    def update_units(self, order_ref, units):
+        """
+        Update the units still resting of an order, e.g. after it was partly traded
+        :param order_ref:
+        :param units: remaining units
+        :return: the order if its units changed, None otherwise
+        """
+        current_order = self._orders.get(order_ref)
+        if current_order is None or current_order.order_status not in self._OUTSTANDING or \
+                current_order.units == units:
+            return None
+
+        current_order.units = units
+        if self._on_change is not None:
+            self._on_change(current_order)
+        return current_order
+
+    def get(self, order_ref):
+        return self._orders.get(order_ref)
+
+    def outstanding(self, market_item):
+        """
+        Number of sent or accepted orders in a market
+        :param market_item:
+        :return:
+        """
+        return len(self._outstanding.get(market_item, ()))
+
+    def outstanding_orders(self, market_item=None):
+        """
+        Sent or accepted orders in a market
+        :param market_item: None for every market
+        :return:
+        """
+        if market_item is None:
+            return [current_order for market_orders in self._outstanding.values()
+                    for current_order in market_orders.values()]
+        return self._outstanding.get(market_item, {}).values()
+
+    def request_cancel(self, order_ref):
+        self._cancel_requests.add(order_ref)
+
+    def cancel_requested(self, order_ref):
+        return order_ref in self._cancel_requests
+
+    def orders(self, order_status):
+        """
+        Orders currently in a given status, keyed by ref
+        :param order_status:
+        :return:
+        """
+        return self._orders_by_status[order_status]
 
 
 class _CurrentOrder:
@@ -479,25 +1489,26 @@ class _CurrentOrder:
     Adapted from Project 1 - Task 1 Code
     Wrapper class to store information about an Order and provides functionality to create new orders
     """
-    def __init__(self, price, order_side, trade_market_id, capm_bot):
+    __slots__ = ("price", "order_side", "trade_market_id", "units", "order_status", "date_created", "ref", "fm_id")
+
+    def __init__(self, price, order_side, trade_market_id, units=1):
         self.price = price
         self.order_side = order_side
         self.trade_market_id = trade_market_id
+        self.units = units
         self.order_status = None
+        self.fm_id = None
         self.date_created = datetime.now()
         self.ref = f"Asset-{self.trade_market_id.item}-Price-{self.price}-OrderSide-{self.order_side}" \
                    f"-[{SUBMISSION['student_number']}]-{self.date_created}"
 
-        capm_bot.send_order(self._create_order())
-        self.order_status = OrderStatus(0)
-
     def _create_order(self):
         # submit the order
         new_order = Order.create_new(self.trade_market_id)
         new_order.order_side = self.order_side
         new_order.order_type = OrderType.LIMIT
         new_order.price = self.price
-        new_order.units = 1
+        new_order.units = self.units
         new_order.ref = self.ref
 
         # return new_order
@@ -508,5 +1519,6 @@ class _CurrentOrder:
 
 
 if __name__ == "__main__":
-    bot = CAPMBot(FM_ACCOUNT, FM_EMAIL, FM_PASSWORD, MARKETPLACE_ID)
+    bot = CAPMBot(os.environ["FM_ACCOUNT"], os.environ["FM_EMAIL"], os.environ["FM_PASSWORD"],
+                  int(os.environ.get("FM_MARKETPLACE_ID", MARKETPLACE_ID)))
     bot.run()
@@ -0,0 +1,146 @@
+"""
+Benchmark harness for the CAPM Bot.
+
+Replays synthetic order streams through the offline market simulator and reports per-callback latency percentiles and
+performance evaluations per second, for configurable numbers of securities and book depths.
+
+Usage:
+    python benchmark.py --securities 4 10 25 --depths 10 100 --updates 2000
+"""
+import argparse
+import math
+import time
+from itertools import combinations
+
+from market_sim import MarketSimulator, load_capm_bot, synthetic_markets, synthetic_order_stream
+
+capm_bot_module = load_capm_bot()
+OrderSide = capm_bot_module.OrderSide
+
+
+def run_replay(no_securities, book_depth, no_updates, batch_size=1, seed=0, risk_penalty=0.007,
+               cash=100000, bot_options=None):
+    """
+    Replay a synthetic order stream into a fresh bot
+    :param no_securities:
+    :param book_depth: resting public orders per side per market
+    :param no_updates: number of order update batches replayed after the book is filled
+    :param batch_size: order events per update
+    :param seed:
+    :param risk_penalty:
+    :param cash: starting cash (cents)
+    :param bot_options: extra keyword arguments for the bot (by default orders are sent inline
+                        without a rate limit)
+    :return: (simulator, replay time in seconds)
+    """
+    markets = synthetic_markets(no_securities, seed=seed)
+    bot_options = dict({"async_orders": False, "max_orders_per_second": None}, **(bot_options or {}))
+    bot = capm_bot_module.CAPMBot("benchmark", "", "", 0, risk_penalty=risk_penalty, **bot_options)
+    simulator = MarketSimulator(bot, markets, cash)
+    simulator.start()
+
+    start = time.perf_counter()
+    simulator.replay(synthetic_order_stream(markets, no_updates, book_depth, batch_size, seed=seed))
+    return simulator, time.perf_counter() - start
+
+
+def dict_performance(bot):
+    """
+    Performance calculation as it was before vectorisation - loops over dicts of pre-calculated unit asset payoffs,
+    variances and covariances (built here once from the bot's statistics)
+    :param bot: bot with payoffs loaded
+    :return: function of (units dict, cash) returning performance
+    """
+    state = bot._state
+    unit_asset_payoffs = {security: state.mean_payoffs[index] for security, index in state.index.items()}
+    asset_variances = {security: state.covariance_matrix[index, index] for security, index in state.index.items()}
+    asset_covariances = {(security, other_security): state.covariance_matrix[index, other_index]
+                         for security, index in state.index.items()
+                         for other_security, other_index in state.index.items() if security != other_security}
+
+    def calculate_performance(units, cash):
+        expected_payoff = cash
+        payoff_variance = 0
+
+        for unit in units.keys():
+            expected_payoff += units[unit] * (unit_asset_payoffs[unit])
+            payoff_variance += math.pow(units[unit], 2) * asset_variances[unit]
+
+        for security_comb in combinations(units.keys(), 2):
+            payoff_variance += \
+                2 * units[security_comb[0]] * units[security_comb[1]] * asset_covariances[security_comb]
+
+        return expected_payoff - (bot._risk_penalty * payoff_variance)
+
+    return calculate_performance
+
+
+def evaluations_per_second(bot, min_time=0.2):
+    """
+    Throughput of the different ways of evaluating a single unit trade, all on pre-calculated statistics
+    :param bot: bot with payoffs and holdings loaded
+    :param min_time: minimum time (seconds) spent timing each evaluation
+    :return: dict of evaluations per second
+    """
+    item, item_index = next(iter(bot._state.index.items()))
+    holdings = dict(bot.units_holdings)
+    holdings[item] += 1
+    cash = (bot.cash - 500) * capm_bot_module.CONVERT_TO_DOLLARS
+    calculate_dict_performance = dict_performance(bot)
+
+    evaluations = {
+        "dict": lambda: calculate_dict_performance(holdings, cash),
+        "vectorised": lambda: bot._calculate_current_performance(True, item, 500, OrderSide.BUY),
+        "delta": lambda: bot._performance_deltas(item_index, 1, 500),
+    }
+
+    throughput = {}
+    for name, evaluation in evaluations.items():
+        no_evaluations = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_time:
+            for _ in range(100):
+                evaluation()
+            no_evaluations += 100
+        throughput[name] = no_evaluations / (time.perf_counter() - start)
+
+    return throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CAPM Bot against synthetic order streams")
+    parser.add_argument("--securities", type=int, nargs="+", default=[4, 10, 25])
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'securities':>10} {'depth':>6} {'callback':>24} {'calls':>7} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'fills':>6} {'updates/s':>10}")
+
+    for no_securities in args.securities:
+        for book_depth in args.depths:
+            simulator, replay_time = run_replay(no_securities, book_depth, args.updates, args.batch_size, args.seed)
+            percentiles = simulator.latency_percentiles()
+            for callback in ("received_orders", "received_holdings"):
+                if callback not in percentiles:
+                    continue
+                print(f"{no_securities:>10} {book_depth:>6} {callback:>24} {len(simulator.latencies[callback]):>7} "
+                      f"{percentiles[callback][50]:>8.3f} {percentiles[callback][90]:>8.3f} "
+                      f"{percentiles[callback][99]:>8.3f} {simulator.fills:>6} {args.updates / replay_time:>10.0f}")
+
+            metrics = simulator.bot._metrics
+            print(f"{no_securities:>10} {book_depth:>6} evaluations/decision "
+                  f"{metrics.snapshot()['histograms']['evaluations_per_decision']['mean']:.1f}, "
+                  f"price search steps {metrics.counter('price_search_steps')}, "
+                  f"orders sent {metrics.counter('orders_sent')}")
+
+        throughput = evaluations_per_second(simulator.bot)
+        print(f"{no_securities:>10} evaluations/s: " +
+              ", ".join(f"{name} {rate:,.0f}" for name, rate in throughput.items()) +
+              f" (vectorised speed-up x{throughput['vectorised'] / throughput['dict']:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Multi-marketplace, multi-account host for the CAPM Bot.
+
+Runs one bot per (account, marketplace) entry of a JSON config file, each in its own worker process, and restarts
+workers that exit so that one slow or crashed marketplace does not stall the others. When a marketplace's payoffs are
+given in the config, the host computes their mean payoffs and covariance matrix once and holds them in shared memory;
+every bot trading that marketplace attaches to them instead of computing its own, as long as the payoffs (and state
+probabilities) in the market descriptions match.
+
+Config format:
+    {
+        "bots": [
+            {"account": "regular-idol", "email": "...", "password_env": "FM_PASSWORD", "marketplace_id": 1185,
+             "risk_penalty": 0.007, "session_time": 20, "journal": "regular-idol-1185.journal"}
+        ],
+        "payoffs": {"1185": {"A": [1000, 500, 0, 250], ...}},
+        "probabilities": {"1185": [0.25, 0.25, 0.25, 0.25]},
+        "restart_delay": 5,
+        "max_restart_delay": 300
+    }
+
+Passwords are given either directly ("password") or as the name of an environment variable ("password_env"). A bot's
+optional "journal" path is appended to by an OrderJournal (see journal.py). State probabilities of a marketplace
+default to equally likely states.
+
+Usage:
+    python bot_host.py bot_host.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from journal import OrderJournal
+from payoff_statistics import state_probabilities, weighted_statistics
+
+CONVERT_TO_DOLLARS = 1/100
+
+# Constructor arguments passed from a bot's config entry to CAPMBot
+BOT_OPTIONS = ("risk_penalty", "session_time", "async_orders", "max_orders_per_second", "proactive_orders",
+               "decision_interval", "state_probabilities", "statistics_dtype", "max_cancels_per_second")
+
+logger = logging.getLogger("bot_host")
+
+
+class SharedStatistics:
+    """
+    Payoff statistics of one marketplace held in shared memory: the payoffs (cents) and state probabilities they were
+    computed from, the mean payoffs and the covariance matrix of payoffs (dollars)
+    """
+    def __init__(self, payoffs, probabilities=None):
+        """
+        :param payoffs: payoffs (cents) in each state keyed by security
+        :param probabilities: state probabilities (None for equally likely states)
+        """
+        self.securities = list(payoffs)
+        payoffs = np.array([payoffs[security] for security in self.securities], dtype=np.int64)
+        self.no_states = payoffs.shape[1]
+        probabilities = state_probabilities(self.no_states, probabilities)
+        mean_payoffs, covariance_matrix = weighted_statistics(payoffs * CONVERT_TO_DOLLARS, probabilities)
+
+        statistics = (payoffs, probabilities, mean_payoffs, covariance_matrix)
+        self._shared_memory = shared_memory.SharedMemory(create=True,
+                                                         size=max(sum(array.nbytes for array in statistics), 1))
+        for shared_array, array in zip(_statistics_arrays(self._shared_memory.buf, len(self.securities),
+                                                          self.no_states), statistics):
+            shared_array[:] = array
+
+    def spec(self):
+        """
+        Picklable description used by worker processes to attach
+        :return:
+        """
+        return {"name": self._shared_memory.name, "securities": self.securities, "no_states": self.no_states}
+
+    def close(self):
+        self._shared_memory.close()
+        self._shared_memory.unlink()
+
+
+def _statistics_arrays(buffer, no_securities, no_states):
+    """
+    Views of the payoffs, state probabilities, mean payoffs and covariance matrix laid out back to back in a buffer
+    :return: list of arrays
+    """
+    arrays = []
+    offset = 0
+    for dtype, shape in ((np.int64, (no_securities, no_states)), (np.float64, (no_states,)),
+                         (np.float64, (no_securities,)), (np.float64, (no_securities, no_securities))):
+        array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        offset += array.nbytes
+        arrays.append(array)
+    return arrays
+
+
+def attach_shared_statistics(spec):
+    """
+    Attach to shared payoff statistics from a worker process
+    :param spec: SharedStatistics.spec()
+    :return: (shared memory handle - keep a reference while the statistics are used,
+              (securities, payoffs, probabilities, mean payoffs, covariance matrix) as read-only arrays)
+    """
+    shared_statistics_memory = shared_memory.SharedMemory(name=spec["name"])
+    statistics = _statistics_arrays(shared_statistics_memory.buf, len(spec["securities"]), spec["no_states"])
+    for array in statistics:
+        array.flags.writeable = False
+    return shared_statistics_memory, (spec["securities"], *statistics)
+
+
+def run_bot(bot_config, shared_statistics_spec=None):
+    """
+    Worker process entry point - runs a single bot until it exits
+    :param bot_config: config entry of the bot
+    :param shared_statistics_spec: SharedStatistics.spec() of the bot's marketplace, if any
+    """
+    from CAPMBot import CAPMBot
+
+    shared_statistics_memory, shared_statistics = None, None
+    if shared_statistics_spec is not None:
+        shared_statistics_memory, shared_statistics = attach_shared_statistics(shared_statistics_spec)
+
+    password = bot_config.get("password")
+    if password is None:
+        password = os.environ[bot_config["password_env"]]
+
+    journal = None
+    if bot_config.get("journal") is not None:
+        journal = OrderJournal(bot_config["journal"])
+
+    options = {option: bot_config[option] for option in BOT_OPTIONS if option in bot_config}
+    bot = CAPMBot(bot_config["account"], bot_config["email"], password, bot_config["marketplace_id"],
+                  shared_statistics=shared_statistics, journal=journal, **options)
+
+    # The host stops workers with SIGTERM - exit through SystemExit so that buffered journal records are written
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        bot.run()
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _exit_on_sigterm(signum, frame):
+    raise SystemExit(0)
+
+
+class _Worker:
+    __slots__ = ("bot_config", "process", "restarts", "restart_time", "started_time")
+
+    def __init__(self, bot_config):
+        self.bot_config = bot_config
+        self.process = None
+        self.restarts = 0
+        self.restart_time = 0.0
+        self.started_time = 0.0
+
+    @property
+    def name(self):
+        return f"{self.bot_config['account']}@{self.bot_config['marketplace_id']}"
+
+
+class BotHost:
+    """
+    Supervises one worker process per bot, restarting workers that exit with exponential backoff
+    """
+    def __init__(self, config, poll_interval=1.0):
+        """
+        :param config: parsed config (see module docstring)
+        :param poll_interval: seconds between worker health checks
+        """
+        self._restart_delay = config.get("restart_delay", 5)
+        self._max_restart_delay = config.get("max_restart_delay", 300)
+        self._poll_interval = poll_interval
+        self._context = multiprocessing.get_context("spawn")
+
+        probabilities = config.get("probabilities", {})
+        self._shared_statistics = {str(marketplace_id): SharedStatistics(payoffs, probabilities.get(marketplace_id))
+                                   for marketplace_id, payoffs in config.get("payoffs", {}).items()}
+        self._workers = [_Worker(bot_config) for bot_config in config["bots"]]
+        self._stopped = False
+
+    def run(self):
+        """
+        Start every worker and supervise them until stop() is called (or the host is interrupted)
+        """
+        try:
+            while not self._stopped:
+                for worker in self._workers:
+                    self._supervise(worker)
+                time.sleep(self._poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self._stopped = True
+
+    def shutdown(self):
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(5)
+        for shared_statistics in self._shared_statistics.values():
+            shared_statistics.close()
+        self._shared_statistics = {}
+
+    def status(self):
+        """
+        :return: list of (worker name, alive, restarts)
+        """
+        return [(worker.name, worker.process is not None and worker.process.is_alive(), worker.restarts)
+                for worker in self._workers]
+
+    def _supervise(self, worker):
+        if worker.process is not None and worker.process.is_alive():
+            return
+
+        now = time.monotonic()
+        if worker.process is not None:
+            # reset the backoff once a worker has stayed up for the maximum delay
+            if now - worker.started_time > self._max_restart_delay:
+                worker.restarts = 0
+            logger.warning(f"Bot {worker.name} exited with code {worker.process.exitcode}")
+            worker.restart_time = now + min(self._restart_delay * 2 ** worker.restarts, self._max_restart_delay)
+            worker.restarts += 1
+            worker.process = None
+
+        if now < worker.restart_time:
+            return
+
+        shared_statistics = self._shared_statistics.get(str(worker.bot_config["marketplace_id"]))
+        worker.process = self._context.Process(
+            target=run_bot, name=f"capm-bot-{worker.name}",
+            args=(worker.bot_config, shared_statistics.spec() if shared_statistics is not None else None))
+        worker.process.start()
+        worker.started_time = now
+        logger.info(f"Started bot {worker.name} (pid {worker.process.pid})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run CAPM Bots for many accounts and marketplaces")
+    parser.add_argument("config", help="JSON config file")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s: %(name)s] %(levelname)s - %(message)s")
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+
+    BotHost(config, args.poll_interval).run()
+
+
+if __name__ == "__main__":
+    main()
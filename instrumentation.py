@@ -0,0 +1,239 @@
+"""
+Low overhead instrumentation for the CAPM Bot.
+
+Timers and counters are recorded into rolling histograms that can be read in-process (Instrumentation.snapshot) and
+are periodically dumped to a local JSON file. A sampling profiler can be switched on and off while the bot is running,
+either through the API or by creating/ deleting a control file.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+
+class _RollingHistogram:
+    """
+    Fixed size ring buffer of the most recent observations, plus running totals over all observations
+    """
+    __slots__ = ("_values", "_position", "count", "total", "max")
+
+    def __init__(self, size):
+        self._values = np.zeros(size)
+        self._position = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self._values[self._position] = value
+        self._position = (self._position + 1) % len(self._values)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def summary(self, percentiles=(50, 90, 99)):
+        recent_values = self._values[:min(self.count, len(self._values))]
+        summary = {"count": self.count, "mean": self.total / self.count if self.count else 0.0, "max": self.max}
+        if self.count:
+            summary.update({f"p{percentile}": value
+                            for percentile, value in zip(percentiles, np.percentile(recent_values, percentiles))})
+        return summary
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.add(time.perf_counter() - self._start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _SamplingProfiler(threading.Thread):
+    """
+    Samples the stack of a target thread at a fixed interval and counts the functions seen
+    """
+    def __init__(self, target_thread_id, interval):
+        super().__init__(name="capm-bot-profiler", daemon=True)
+        self._target_thread_id = target_thread_id
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.samples = 0
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            frame = sys._current_frames().get(self._target_thread_id)
+            if frame is None:
+                continue
+
+            self.samples += 1
+            self.self_counts[self._frame_key(frame)] += 1
+
+            seen = set()
+            while frame is not None:
+                frame_key = self._frame_key(frame)
+                if frame_key not in seen:
+                    seen.add(frame_key)
+                    self.total_counts[frame_key] += 1
+                frame = frame.f_back
+
+    def stop(self):
+        self._stop_event.set()
+
+    @staticmethod
+    def _frame_key(frame):
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+class Instrumentation:
+    """
+    Timers, counters and rolling histograms for the bot's callbacks and core computations
+    """
+    def __init__(self, enabled=True, histogram_size=1024, dump_path=None, dump_interval=60,
+                 profiler_control_path=None, profiler_interval=0.005):
+        """
+        :param enabled: when disabled, timers and counters are no-ops
+        :param histogram_size: number of recent observations kept per histogram
+        :param dump_path: JSON file the snapshot is periodically written to (None to disable)
+        :param dump_interval: seconds between dumps
+        :param profiler_control_path: the sampling profiler runs while this file exists (None to disable)
+        :param profiler_interval: seconds between profiler samples
+        """
+        self.enabled = enabled
+        self._histogram_size = histogram_size
+        self._dump_path = dump_path
+        self._dump_interval = dump_interval
+        self._profiler_control_path = profiler_control_path
+        self._profiler_interval = profiler_interval
+
+        self._histograms = {}
+        self._counters = Counter()
+        self._last_dump = time.monotonic()
+        self._profiler = None
+        self._last_profile = None
+
+    def timer(self, name):
+        """
+        Context manager timing a block of code into the histogram of the given name
+        :param name:
+        :return:
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self._histogram(name))
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self._counters[name] += amount
+
+    def observe(self, name, value):
+        if self.enabled:
+            self._histogram(name).add(value)
+
+    def counter(self, name):
+        return self._counters[name]
+
+    def snapshot(self):
+        """
+        Current counters and histogram summaries (timers are in seconds)
+        :return: dict
+        """
+        snapshot = {
+            "time": time.time(),
+            "counters": dict(self._counters),
+            "histograms": {name: histogram.summary() for name, histogram in self._histograms.items()},
+        }
+        if self._profiler is not None or self._last_profile is not None:
+            snapshot["profile"] = self.profile()
+        return snapshot
+
+    def reset(self):
+        self._histograms = {}
+        self._counters = Counter()
+
+    def maybe_dump(self):
+        """
+        Dump the snapshot if the dump interval has passed, and start/ stop the profiler if its control file has
+        been created/ deleted. Cheap enough to call from every callback
+        """
+        if not self.enabled or time.monotonic() - self._last_dump < self._dump_interval:
+            return
+        self._last_dump = time.monotonic()
+
+        if self._profiler_control_path is not None:
+            if os.path.exists(self._profiler_control_path):
+                self.enable_profiler()
+            else:
+                self.disable_profiler()
+
+        if self._dump_path is not None:
+            self.dump(self._dump_path)
+
+    def dump(self, path):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as dump_file:
+            json.dump(self.snapshot(), dump_file, indent=1)
+        os.replace(temporary_path, path)
+
+    def enable_profiler(self, thread_id=None):
+        """
+        Start sampling the stack of the given thread (defaults to the calling thread)
+        :param thread_id:
+        """
+        if self._profiler is not None:
+            return
+        self._profiler = _SamplingProfiler(thread_id or threading.get_ident(), self._profiler_interval)
+        self._profiler.start()
+
+    def disable_profiler(self):
+        if self._profiler is None:
+            return
+        self._profiler.stop()
+        self._last_profile = self._profiler
+        self._profiler = None
+
+    def profile(self, top=20):
+        """
+        Most sampled functions from the running (or last) profiler
+        :param top: number of functions returned
+        :return: dict of samples, self and total (inclusive) sample counts
+        """
+        profiler = self._profiler or self._last_profile
+        if profiler is None:
+            return None
+        return {
+            "samples": profiler.samples,
+            "self": profiler.self_counts.most_common(top),
+            "total": profiler.total_counts.most_common(top),
+        }
+
+    def _histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = _RollingHistogram(self._histogram_size)
+        return histogram
@@ -0,0 +1,288 @@
+"""
+Append-only binary journal of everything the CAPM Bot receives and does.
+
+Every received order, holdings snapshot, session transition and own order state change is written as a fixed-width
+record (RECORD_DTYPE) after a short header, so a journal can be memory-mapped and read back with zero copy as a NumPy
+structured array (read_journal), e.g. to analyse a long session or to replay it into the offline simulator
+(order_stream). Records are buffered in memory and written in blocks.
+
+Record fields:
+    time        wall clock time (seconds since the epoch)
+    batch       callback sequence number - records written by the same callback share a batch
+    kind        ORDER, HOLDING, CASH, SESSION or OWN_ORDER
+    side        NO_SIDE, BUY or SELL
+    flags       MINE, CANCELLED, TRADED, PENDING (orders), SESSION_OPEN (session transitions)
+    status      OrderStatus value of own order state changes
+    market_id   market fm id
+    fm_id       order fm id (0 for own orders not yet accepted)
+    ref         64 bit hash of the order ref (ref_id) - joins own orders with their order updates
+    price       order price (cents)
+    units       order units, units held (HOLDING) or cash (CASH)
+    available   units available (HOLDING) or cash available (CASH)
+"""
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"CAPMJRNL"
+VERSION = 1
+
+RECORD_DTYPE = np.dtype([
+    ("time", "<f8"),
+    ("batch", "<u4"),
+    ("kind", "u1"),
+    ("side", "u1"),
+    ("flags", "u1"),
+    ("status", "u1"),
+    ("market_id", "<i4"),
+    ("fm_id", "<i8"),
+    ("ref", "<u8"),
+    ("price", "<i8"),
+    ("units", "<i8"),
+    ("available", "<i8"),
+])
+
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("record_size", "<u4")])
+
+# Record kinds
+ORDER = 1
+HOLDING = 2
+CASH = 3
+SESSION = 4
+OWN_ORDER = 5
+
+# Order sides
+NO_SIDE = 0
+BUY = 1
+SELL = 2
+_SIDES = {"BUY": BUY, "SELL": SELL}
+
+# Flags
+MINE = 1
+CANCELLED = 2
+TRADED = 4
+PENDING = 8
+SESSION_OPEN = 16
+
+
+def ref_id(ref):
+    """
+    Stable 64 bit id of an order ref
+    :param ref:
+    :return: int (0 for orders without a ref)
+    """
+    if not ref:
+        return 0
+    return int.from_bytes(hashlib.blake2b(ref.encode(), digest_size=8).digest(), "little")
+
+
+def _side(order_side):
+    return _SIDES.get(order_side.name, NO_SIDE) if order_side is not None else NO_SIDE
+
+
+class OrderJournal:
+    """
+    Buffered writer appending fixed-width records to a journal file
+    """
+    def __init__(self, path, buffer_records=4096, flush_interval=1.0):
+        """
+        :param path: journal file - appended to if it already exists
+        :param buffer_records: records buffered before they are written
+        :param flush_interval: maximum seconds records are buffered between callbacks
+        """
+        self.path = path
+        self._buffer_records = buffer_records
+        self._flush_interval = flush_interval
+
+        self._records = []
+        self._batch = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._journal_file = self._open(path)
+
+    def record_orders(self, orders):
+        """
+        Record a batch of order updates (as passed to received_orders)
+        :param orders:
+        """
+        now = time.time()
+        with self._lock:
+            self._batch += 1
+            for order in orders:
+                flags = (MINE if order.mine else 0) | (CANCELLED if order.is_cancelled else 0) | \
+                        (TRADED if order.traded_order is not None else 0) | (PENDING if order.is_pending else 0)
+                self._records.append((now, self._batch, ORDER, _side(order.order_side), flags, 0,
+                                      order.market.fm_id, order.fm_id or 0, ref_id(order.ref), order.price or 0,
+                                      order.units or 0, 0))
+            self._flush_if_due()
+
+    def record_holdings(self, holdings):
+        """
+        Record a holdings snapshot - one CASH record followed by a HOLDING record per market
+        :param holdings:
+        """
+        now = time.time()
+        with self._lock:
+            self._batch += 1
+            self._records.append((now, self._batch, CASH, NO_SIDE, 0, 0, 0, 0, 0, 0,
+                                  holdings.cash, holdings.cash_available))
+            for market, asset in holdings.assets.items():
+                self._records.append((now, self._batch, HOLDING, NO_SIDE, 0, 0, market.fm_id, 0, 0, 0,
+                                      asset.units, asset.units_available))
+            self._flush_if_due()
+
+    def record_session(self, is_open):
+        """
+        Record a session transition - buffered records are written immediately
+        :param is_open:
+        """
+        with self._lock:
+            self._batch += 1
+            self._records.append((time.time(), self._batch, SESSION, NO_SIDE, SESSION_OPEN if is_open else 0, 0,
+                                  0, 0, 0, 0, 0, 0))
+            self._flush()
+
+    def record_own_order(self, current_order):
+        """
+        Record a state change of one of our own orders
+        :param current_order: _CurrentOrder, after its status (or remaining units) changed
+        """
+        with self._lock:
+            self._records.append((time.time(), self._batch, OWN_ORDER, _side(current_order.order_side), MINE,
+                                  current_order.order_status.value, current_order.trade_market_id.fm_id,
+                                  current_order.fm_id or 0, ref_id(current_order.ref), current_order.price,
+                                  current_order.units, 0))
+            if len(self._records) >= self._buffer_records:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._journal_file.close()
+
+    def _flush_if_due(self):
+        if len(self._records) >= self._buffer_records or \
+                time.monotonic() - self._last_flush >= self._flush_interval:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._records:
+            return
+        self._journal_file.write(np.array(self._records, dtype=RECORD_DTYPE).tobytes())
+        self._journal_file.flush()
+        self._records = []
+
+    @staticmethod
+    def _open(path):
+        """
+        Open the journal for appending, writing the header of a new journal and dropping any partly written
+        record at the end of an existing one
+        :param path:
+        :return: file
+        """
+        journal_size = os.path.getsize(path) if os.path.exists(path) else 0
+        if journal_size == 0:
+            journal_file = open(path, "wb")
+            journal_file.write(np.array([(MAGIC, VERSION, RECORD_DTYPE.itemsize)], dtype=HEADER_DTYPE).tobytes())
+            return journal_file
+
+        _check_header(path)
+        no_records = (journal_size - HEADER_DTYPE.itemsize) // RECORD_DTYPE.itemsize
+        journal_file = open(path, "r+b")
+        journal_file.truncate(HEADER_DTYPE.itemsize + no_records * RECORD_DTYPE.itemsize)
+        journal_file.seek(0, os.SEEK_END)
+        return journal_file
+
+
+def _check_header(path):
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header["magic"][0] != MAGIC:
+        raise ValueError(f"{path} is not a CAPM Bot journal")
+    if header["version"][0] != VERSION or header["record_size"][0] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} has an unsupported journal version {header['version'][0]}")
+
+
+def read_journal(path):
+    """
+    Memory-map a journal (zero copy) - a partly written last record is ignored
+    :param path:
+    :return: read-only structured array of RECORD_DTYPE
+    """
+    _check_header(path)
+    no_records = (os.path.getsize(path) - HEADER_DTYPE.itemsize) // RECORD_DTYPE.itemsize
+    if no_records == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_DTYPE.itemsize, shape=(no_records,))
+
+
+def order_stream(records):
+    """
+    Public order events in the format replayed by market_sim.MarketSimulator.apply_events - one batch per
+    received_orders callback. Orders are added when first seen (and re-matched by the simulator) and cancelled when
+    seen cancelled. Orders are first seen with the units left after trading on arrival, so the units traded by resting
+    orders (public or our own) in the same batch - found from the drop in their units - are added back, and the
+    replayed orders trade against the same resting orders (including the bot's quotes) again
+    :param records: journal records (read_journal)
+    :return: generator of event batches
+    """
+    order_records = records[(records["kind"] == ORDER) | (records["kind"] == OWN_ORDER)]
+    seen_orders = set()
+    order_units = {}
+    batch_starts = np.flatnonzero(np.diff(order_records["batch"], prepend=-1))
+    for batch_records in np.split(order_records, batch_starts[1:]):
+        resting_traded_units = _resting_traded_units(batch_records, order_units)
+
+        events = []
+        for record in batch_records:
+            if record["kind"] != ORDER or record["flags"] & MINE:
+                continue
+
+            fm_id = int(record["fm_id"])
+            if record["flags"] & CANCELLED:
+                if fm_id in seen_orders:
+                    events.append({"action": "cancel", "id": fm_id})
+                    seen_orders.discard(fm_id)
+                continue
+            if fm_id in seen_orders:
+                continue
+
+            # an order traded on arrival against resting orders on the opposite side
+            units = int(record["units"])
+            if record["flags"] & TRADED:
+                resting_side = SELL if record["side"] == BUY else BUY
+                units += resting_traded_units.pop((int(record["market_id"]), resting_side), 0)
+            if units > 0:
+                seen_orders.add(fm_id)
+                events.append({"action": "new", "id": fm_id, "market": int(record["market_id"]),
+                               "side": "BUY" if record["side"] == BUY else "SELL", "price": int(record["price"]),
+                               "units": units})
+        if events:
+            yield events
+
+
+def _resting_traded_units(batch_records, order_units):
+    """
+    Units traded in one batch by orders seen before it, from the drop in their units
+    :param batch_records: ORDER and OWN_ORDER records of one batch
+    :param order_units: last seen units of every order, keyed by ref id (our orders) or fm id - updated
+    :return: dict of traded units keyed by (market id, side of the resting orders)
+    """
+    resting_traded_units = {}
+    for record in batch_records:
+        order_key = ("ref", int(record["ref"])) if record["flags"] & MINE else ("fm_id", int(record["fm_id"]))
+        units = int(record["units"])
+        if record["kind"] == ORDER and record["flags"] & TRADED and order_key in order_units:
+            side_key = (int(record["market_id"]), int(record["side"]))
+            resting_traded_units[side_key] = resting_traded_units.get(side_key, 0) + \
+                max(0, order_units[order_key] - units)
+        order_units[order_key] = units
+
+    return resting_traded_units
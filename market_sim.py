@@ -0,0 +1,560 @@
+"""
+Offline market replay simulator for the CAPM Bot.
+
+Provides a local stand-in for the parts of fmclient used by the bot (Agent, Order, OrderSide, OrderType, Session and
+holdings) and a simple price-time priority matching engine, so that recorded or synthetic order streams can be replayed
+into the bot's callbacks without a live marketplace.
+
+Usage:
+    market_sim = load_market_sim()           # registers this module as fmclient
+    capm_bot_module = load_capm_bot()        # imports CAPMBot against the stand-in
+"""
+import bisect
+import importlib
+import json
+import sys
+import time
+from enum import Enum
+
+import numpy as np
+
+import payoff_statistics
+
+
+class OrderSide(Enum):
+    BUY = 0
+    SELL = 1
+
+
+class OrderType(Enum):
+    LIMIT = 0
+    CANCEL = 1
+
+
+class Market:
+    """
+    Stand-in for fmclient.Market
+    """
+    def __init__(self, fm_id, item, description, min_price=0, max_price=1000, price_tick=1, max_units=5):
+        self.fm_id = fm_id
+        self.item = item
+        self.description = description
+        self.min_price = min_price
+        self.max_price = max_price
+        self.price_tick = price_tick
+        self.max_units = max_units
+
+    def __repr__(self):
+        return f"Market({self.fm_id}, {self.item})"
+
+
+class Session:
+    """
+    Stand-in for fmclient.Session
+    """
+    def __init__(self, is_open):
+        self.is_open = is_open
+        self.is_closed = not is_open
+
+
+class Asset:
+    def __init__(self, units, units_available):
+        self.units = units
+        self.units_available = units_available
+
+
+class Holding:
+    """
+    Stand-in for the holdings object passed to received_holdings
+    """
+    def __init__(self, cash, cash_available, assets):
+        self.cash = cash
+        self.cash_available = cash_available
+        self.assets = assets
+
+
+class Order:
+    """
+    Stand-in for fmclient.Order - all orders known to the simulator are kept in a class level registry, as in fmclient
+    """
+    _all_orders = {}
+
+    def __init__(self):
+        self.fm_id = None
+        self.ref = None
+        self.market = None
+        self.order_side = None
+        self.order_type = OrderType.LIMIT
+        self.price = None
+        self.units = 1
+        self.mine = False
+        self.is_pending = False
+        self.is_cancelled = False
+        self.traded_order = None
+
+    @classmethod
+    def all(cls):
+        return cls._all_orders
+
+    @classmethod
+    def create_new(cls, market=None):
+        new_order = cls()
+        new_order.market = market
+        return new_order
+
+    def __repr__(self):
+        return f"Order({self.fm_id}, {self.market.item}, {self.order_side.name}, {self.units}@{self.price})"
+
+
+class Agent:
+    """
+    Stand-in for fmclient.Agent - orders are sent to the attached MarketSimulator instead of the marketplace
+    """
+    def __init__(self, account, email, password, marketplace_id, name=None):
+        self.account = account
+        self.marketplace_id = marketplace_id
+        self.name = name
+        self.markets = {}
+        self.messages = []
+        self.periodic_tasks = []
+        self._simulator = None
+
+    def inform(self, message):
+        self.messages.append(message)
+
+    def send_order(self, order):
+        self._simulator.submit(order)
+
+    def execute_periodically(self, func, sleep_time):
+        """
+        Register a task run by the simulator every sleep_time seconds, and whenever the replayed stream is idle
+        """
+        self.periodic_tasks.append((func, sleep_time))
+
+    def run(self):
+        raise RuntimeError("Offline agents are driven by a MarketSimulator, use MarketSimulator.replay")
+
+
+def load_market_sim():
+    """
+    Register this module as fmclient so that the bot imports the offline stand-ins
+    :return: this module
+    """
+    market_sim = sys.modules[__name__]
+    fmclient = sys.modules.get("fmclient")
+    if fmclient is not None and fmclient is not market_sim:
+        raise RuntimeError("fmclient has already been imported, the offline simulator must be loaded first")
+
+    sys.modules["fmclient"] = market_sim
+    return market_sim
+
+
+def load_capm_bot():
+    """
+    Import the CAPMBot module against the offline stand-ins
+    :return: CAPMBot module
+    """
+    load_market_sim()
+    return importlib.import_module("CAPMBot")
+
+
+class MarketSimulator:
+    """
+    Replays order streams into a bot and matches the bot's own orders against the replayed book
+    Outbound orders are queued and processed after the current callback returns, as they would be by the marketplace
+    The bot's periodic tasks (Agent.execute_periodically) run after each replayed update once they are due, and once
+    more after the replayed stream ends, one period later - as they would while the marketplace is quiet
+    """
+    OWN_ORDER_ID_START = 1_000_000_000
+
+    def __init__(self, bot, markets, cash, units=None, allow_short=True, max_rounds=100):
+        """
+        :param bot: bot to drive
+        :param markets: list of Market
+        :param cash: starting cash (cents)
+        :param units: starting units keyed by market fm id
+        :param allow_short: allow sell orders beyond the units held
+        :param max_rounds: maximum number of order/ callback rounds processed per replayed update
+        """
+        self.bot = bot
+        self.markets = {market.fm_id: market for market in markets}
+        self.allow_short = allow_short
+        self.max_rounds = max_rounds
+
+        self.cash = cash
+        self.units = {fm_id: 0 for fm_id in self.markets}
+        self.units.update(units or {})
+
+        self.latencies = {}
+        self.fills = 0
+        self.orders_sent = 0
+        self.orders_rejected = 0
+
+        self._outbox = []
+        self._book = {(fm_id, order_side): [] for fm_id in self.markets for order_side in OrderSide}
+        self._sequence = 0
+        self._next_own_id = self.OWN_ORDER_ID_START
+        self._periodic_task_runs = {}
+
+        Order._all_orders = {}
+        bot.markets = dict(self.markets)
+        bot._simulator = self
+
+    def start(self):
+        """
+        Run the bot's start up callbacks and open the session
+        """
+        self._deliver("initialised")
+        self._deliver("pre_start_tasks")
+        self._deliver("received_session_info", Session(is_open=True))
+        self._deliver("received_holdings", self.holdings())
+
+    def close(self):
+        self._deliver("received_session_info", Session(is_open=False))
+
+    def replay(self, order_stream):
+        """
+        Replay a stream of public order updates
+        :param order_stream: iterable of lists of order events (see apply_events)
+        """
+        for events in order_stream:
+            self.apply_events(events)
+
+        self.run_periodic_tasks(idle=True)
+
+    def apply_events(self, events):
+        """
+        Apply a batch of public order events and deliver the resulting callbacks
+        :param events: list of dicts - {"action": "new", "id", "market", "side", "price", "units"} or
+                       {"action": "cancel", "id"}
+        """
+        changed_orders = []
+        holdings_changed = False
+
+        for event in events:
+            if event["action"] == "cancel":
+                order = Order._all_orders.get(event["id"])
+                if order is not None and order.is_pending and not order.mine:
+                    self._remove_resting(order)
+                    order.is_pending = False
+                    order.is_cancelled = True
+                    changed_orders.append(order)
+                continue
+
+            order = Order.create_new(self.markets[event["market"]])
+            order.fm_id = event["id"]
+            order.order_side = event["side"] if isinstance(event["side"], OrderSide) else OrderSide[event["side"]]
+            order.price = event["price"]
+            order.units = event.get("units", 1)
+            Order._all_orders[order.fm_id] = order
+
+            holdings_changed |= self._match(order, changed_orders)
+
+        if changed_orders:
+            self._deliver("received_orders", changed_orders)
+        if holdings_changed:
+            self._deliver("received_holdings", self.holdings())
+
+        self._process_outbox()
+        self.run_periodic_tasks()
+
+    def run_periodic_tasks(self, idle=False):
+        """
+        Run the bot's periodic tasks that are due, then process the orders they sent
+        :param idle: no more updates are queued - wait for one period of the tasks and run every task, repeated while
+                     the tasks send orders (up to max_rounds)
+        """
+        if not idle:
+            self._run_periodic_tasks(lambda task_index, sleep_time, now:
+                                     now - self._periodic_task_runs.get(task_index, float("-inf")) >= sleep_time)
+            return
+
+        for _ in range(self.max_rounds):
+            if not self.bot.periodic_tasks:
+                return
+            time.sleep(max(sleep_time for func, sleep_time in self.bot.periodic_tasks))
+            if not self._run_periodic_tasks(lambda task_index, sleep_time, now: True):
+                return
+
+    def _run_periodic_tasks(self, is_due):
+        """
+        :return: True if the tasks sent any orders
+        """
+        now = time.monotonic()
+        for task_index, (func, sleep_time) in enumerate(self.bot.periodic_tasks):
+            if is_due(task_index, sleep_time, now):
+                self._periodic_task_runs[task_index] = now
+                start = time.perf_counter()
+                func()
+                self.latencies.setdefault("periodic_tasks", []).append(time.perf_counter() - start)
+
+        orders_sent = bool(self._outbox)
+        self._process_outbox()
+        return orders_sent
+
+    def submit(self, order):
+        """
+        Called by Agent.send_order - the order is processed once the current callback returns
+        """
+        self._outbox.append(order)
+
+    def holdings(self):
+        """
+        Current holdings, with cash and units reserved by our resting orders excluded from the available amounts
+        :return: Holding
+        """
+        cash_available = self.cash
+        units_available = dict(self.units)
+        for (fm_id, order_side), resting_orders in self._book.items():
+            for price_priority, sequence, order in resting_orders:
+                if order.mine and order_side == OrderSide.BUY:
+                    cash_available -= order.price * order.units
+                elif order.mine:
+                    units_available[fm_id] -= order.units
+
+        assets = {market: Asset(self.units[fm_id], units_available[fm_id]) for fm_id, market in self.markets.items()}
+        return Holding(self.cash, cash_available, assets)
+
+    def performance(self, risk_penalty, state_probabilities=None):
+        """
+        Settled performance of the bot's holdings: expected payoff - b * payoff variance (in dollars)
+        :param risk_penalty:
+        :param state_probabilities: defaults to the probabilities in the market descriptions (see
+                                    payoff_statistics.common_probabilities)
+        :return:
+        """
+        descriptions = [payoff_statistics.parse_description(market.description) for market in self.markets.values()]
+        payoffs = np.array([payoffs for payoffs, probabilities in descriptions], dtype=float) / 100
+        if state_probabilities is None:
+            state_probabilities = payoff_statistics.common_probabilities(
+                payoffs.shape[1], [probabilities for payoffs, probabilities in descriptions])
+        else:
+            state_probabilities = payoff_statistics.state_probabilities(payoffs.shape[1], state_probabilities)
+
+        state_payoffs = self.cash / 100 + np.array(list(self.units.values()), dtype=float) @ payoffs
+        expected_payoff = state_payoffs @ state_probabilities
+        payoff_variance = ((state_payoffs - expected_payoff) ** 2) @ state_probabilities
+
+        return expected_payoff - risk_penalty * payoff_variance
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Callback latency percentiles in milliseconds, keyed by callback name
+        :param percentiles:
+        :return:
+        """
+        return {callback: dict(zip(percentiles, np.percentile(np.array(latencies) * 1000, percentiles)))
+                for callback, latencies in self.latencies.items() if latencies}
+
+    def _deliver(self, callback, *args):
+        start = time.perf_counter()
+        getattr(self.bot, callback)(*args)
+        self.latencies.setdefault(callback, []).append(time.perf_counter() - start)
+
+    def _process_outbox(self):
+        rounds = 0
+        while self._outbox and rounds < self.max_rounds:
+            rounds += 1
+            outbound_orders, self._outbox = self._outbox, []
+
+            changed_orders = []
+            holdings_changed = False
+
+            for order in outbound_orders:
+                if order.order_type == OrderType.CANCEL:
+                    holdings_changed |= self._cancel_own(order, changed_orders)
+                    continue
+
+                rejection = self._validate(order)
+                self.orders_sent += 1
+                if rejection is not None:
+                    self.orders_rejected += 1
+                    self._deliver("order_rejected", rejection, order)
+                    continue
+
+                order.fm_id = self._next_own_id
+                self._next_own_id += 1
+                order.mine = True
+                Order._all_orders[order.fm_id] = order
+                self._deliver("order_accepted", order)
+
+                holdings_changed |= self._match(order, changed_orders)
+
+                # resting orders reserve cash/ units
+                holdings_changed |= order.is_pending
+
+            if changed_orders:
+                self._deliver("received_orders", changed_orders)
+            if holdings_changed:
+                self._deliver("received_holdings", self.holdings())
+
+    def _validate(self, order):
+        market = self.markets.get(order.market.fm_id)
+        if market is None:
+            return {"error": "unknown market"}
+        if not market.min_price <= order.price <= market.max_price or \
+                (order.price - market.min_price) % market.price_tick:
+            return {"error": "invalid price"}
+        if not 1 <= order.units <= market.max_units:
+            return {"error": "invalid units"}
+
+        available = self.holdings()
+        if order.order_side == OrderSide.BUY and order.price * order.units > available.cash_available:
+            return {"error": "insufficient cash"}
+        if order.order_side == OrderSide.SELL and not self.allow_short and \
+                order.units > available.assets[market].units_available:
+            return {"error": "insufficient units"}
+
+        return None
+
+    def _cancel_own(self, cancel_order, changed_orders):
+        order = Order._all_orders.get(cancel_order.fm_id)
+        if order is None or not order.mine or not order.is_pending:
+            return False
+
+        self._remove_resting(order)
+        order.is_pending = False
+        order.is_cancelled = True
+        changed_orders.append(order)
+        return True
+
+    def _match(self, order, changed_orders):
+        """
+        Match an incoming order against the opposite side of the book at the resting order's price, then rest any
+        remaining units
+        :return: True if our holdings changed
+        """
+        holdings_changed = False
+        opposite_side = OrderSide.SELL if order.order_side == OrderSide.BUY else OrderSide.BUY
+        resting_orders = self._book[(order.market.fm_id, opposite_side)]
+
+        while order.units > 0 and resting_orders:
+            resting_order = resting_orders[0][-1]
+            if order.order_side == OrderSide.BUY and resting_order.price > order.price or \
+                    order.order_side == OrderSide.SELL and resting_order.price < order.price:
+                break
+
+            traded_units = min(order.units, resting_order.units)
+            for traded_order, counterparty in ((order, resting_order), (resting_order, order)):
+                traded_order.units -= traded_units
+                traded_order.traded_order = counterparty
+                if traded_order.mine:
+                    direction = 1 if traded_order.order_side == OrderSide.BUY else -1
+                    self.units[order.market.fm_id] += direction * traded_units
+                    self.cash -= direction * traded_units * resting_order.price
+                    self.fills += traded_units
+                    holdings_changed = True
+
+            if resting_order.units == 0:
+                resting_orders.pop(0)
+                resting_order.is_pending = False
+            changed_orders.append(resting_order)
+
+        if order.units > 0:
+            order.is_pending = True
+            self._sequence += 1
+            price_priority = -order.price if order.order_side == OrderSide.BUY else order.price
+            bisect.insort(self._book[(order.market.fm_id, order.order_side)],
+                          (price_priority, self._sequence, order))
+        changed_orders.append(order)
+
+        return holdings_changed
+
+    def _remove_resting(self, order):
+        resting_orders = self._book[(order.market.fm_id, order.order_side)]
+        for position, (price_priority, sequence, resting_order) in enumerate(resting_orders):
+            if resting_order is order:
+                resting_orders.pop(position)
+                break
+
+
+def synthetic_markets(no_securities, no_states=4, seed=0, price_tick=1, max_units=5):
+    """
+    Markets with random payoffs (cents) in each state
+    :param no_securities:
+    :param no_states:
+    :param seed:
+    :param price_tick:
+    :param max_units:
+    :return: list of Market
+    """
+    rng = np.random.default_rng(seed)
+    markets = []
+    for fm_id in range(1, no_securities + 1):
+        payoffs = rng.integers(0, 10, no_states) * 100
+        markets.append(Market(fm_id, f"S{fm_id}", ",".join(str(payoff) for payoff in payoffs),
+                              min_price=0, max_price=1000, price_tick=price_tick, max_units=max_units))
+    return markets
+
+
+def synthetic_order_stream(markets, no_updates, book_depth=10, batch_size=1, spread=60, max_order_units=1, seed=0):
+    """
+    Generate batches of public order events around each market's expected payoff
+    The book is first filled to book_depth orders per side, after which each event either adds an order (which may
+    cross the spread) or cancels a resting order, keeping the book close to book_depth orders per side
+    :param markets: list of Market
+    :param no_updates: number of batches generated after the book is filled
+    :param book_depth: resting orders per side per market
+    :param batch_size: events per batch
+    :param spread: typical distance (cents) of orders from the expected payoff
+    :param max_order_units: orders are for between 1 and max_order_units units
+    :param seed:
+    :return: generator of event batches
+    """
+    rng = np.random.default_rng(seed)
+    fair_values = {}
+    for market in markets:
+        payoffs, probabilities = payoff_statistics.parse_description(market.description)
+        fair_values[market.fm_id] = np.average(payoffs, weights=probabilities)
+    resting = {(market.fm_id, order_side): [] for market in markets for order_side in OrderSide}
+    next_id = 1
+
+    def new_order(market, order_side, distance):
+        nonlocal next_id
+        direction = -1 if order_side == OrderSide.BUY else 1
+        price = fair_values[market.fm_id] + direction * distance
+        price = int(np.clip(round(price / market.price_tick) * market.price_tick, market.min_price, market.max_price))
+        event = {"action": "new", "id": next_id, "market": market.fm_id, "side": order_side, "price": price,
+                 "units": int(rng.integers(1, max_order_units + 1))}
+        resting[(market.fm_id, order_side)].append(next_id)
+        next_id += 1
+        return event
+
+    # fill the book
+    for market in markets:
+        for order_side in OrderSide:
+            yield [new_order(market, order_side, spread + rng.exponential(spread)) for _ in range(book_depth)]
+
+    for _ in range(no_updates):
+        events = []
+        for _ in range(batch_size):
+            market = markets[rng.integers(len(markets))]
+            order_side = OrderSide(rng.integers(2))
+            side_orders = resting[(market.fm_id, order_side)]
+            if len(side_orders) >= book_depth and rng.random() < 0.5:
+                events.append({"action": "cancel", "id": side_orders.pop(rng.integers(len(side_orders)))})
+            else:
+                events.append(new_order(market, order_side, rng.normal(spread, spread)))
+        yield events
+
+
+def load_order_stream(path):
+    """
+    Load a recorded order stream - one JSON list of order events per line, with sides given by name
+    :param path:
+    :return: list of event batches
+    """
+    with open(path) as stream_file:
+        return [json.loads(line) for line in stream_file if line.strip()]
+
+
+def save_order_stream(order_stream, path):
+    """
+    Record an order stream in the format read by load_order_stream
+    :param order_stream: iterable of event batches
+    :param path:
+    """
+    with open(path, "w") as stream_file:
+        for events in order_stream:
+            events = [dict(event, side=event["side"].name) if "side" in event else event for event in events]
+            stream_file.write(json.dumps(events) + "\n")
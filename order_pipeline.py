@@ -0,0 +1,207 @@
+"""
+Outbound order pipeline for the CAPM Bot.
+
+Decision code only enqueues order intents, which are sent to the marketplace subject to a rate limit - by default
+inline when the pipeline is flushed (i.e. on the thread running the bot's callbacks), or optionally by a worker thread
+where the marketplace client allows orders to be sent from other threads. Intents are keyed (e.g. by market and side)
+so that an intent which has not been sent yet is replaced by a newer intent for the same key - the latest decision
+wins and stale quotes are never sent.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter - tokens are refilled at a sustained rate, up to a burst size
+    Taking more tokens than the burst size waits for a full bucket and leaves the bucket in debt
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens per second (None for no rate limit)
+        :param burst: maximum number of tokens available at once
+        """
+        self._rate = rate
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+
+    def available(self, tokens=1):
+        """
+        :param tokens:
+        :return: True if the tokens can be taken now
+        """
+        if self._rate is None:
+            return True
+        self._refill()
+        return self._tokens >= min(tokens, self._burst)
+
+    def take(self, block=False, tokens=1):
+        """
+        Take tokens
+        :param block: wait for the tokens rather than failing
+        :param tokens: number of tokens taken
+        :return: True if the tokens were taken
+        """
+        if self._rate is None:
+            return True
+
+        required_tokens = min(tokens, self._burst)
+        while True:
+            self._refill()
+            if self._tokens >= required_tokens:
+                self._tokens -= tokens
+                return True
+            if not block:
+                return False
+
+            time.sleep((required_tokens - self._tokens) / self._rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+
+class _QueuedIntent:
+    __slots__ = ("orders", "intent", "queued_time")
+
+    def __init__(self, orders, intent):
+        self.orders = orders
+        self.intent = intent
+        self.queued_time = time.perf_counter()
+
+
+class OrderPipeline:
+    """
+    Rate limited, batching order sender
+    By default orders are sent inline by flush(), on the caller's thread - entries the rate limit does not allow yet
+    stay queued until a later flush. In threaded mode orders are sent by a worker thread instead
+    """
+    def __init__(self, send_order, max_orders_per_second=20.0, batch_size=5, threaded=False, on_dropped=None,
+                 is_cancel=None, instrumentation=None):
+        """
+        :param send_order: function sending a single order to the marketplace
+        :param max_orders_per_second: sustained send rate (cancels included) - up to batch_size orders can be sent
+                                      back-to-back (None for no rate limit)
+        :param batch_size: maximum number of intents sent per batch
+        :param threaded: send from a worker thread rather than inline in flush() - only if send_order may be called
+                         from another thread
+        :param on_dropped: called with the intent of every queued entry replaced or cleared before it was sent
+        :param is_cancel: function returning True for cancel orders - cancels from a replaced entry are kept
+        :param instrumentation: optional Instrumentation
+        """
+        self._send_order = send_order
+        self._batch_size = batch_size
+        self._on_dropped = on_dropped
+        self._is_cancel = is_cancel or (lambda order: False)
+        self._metrics = instrumentation
+
+        self._queue = OrderedDict()
+        self._condition = threading.Condition()
+
+        # One token per order sent, refilled at the send rate up to one batch
+        self._rate_limit = TokenBucket(max_orders_per_second, batch_size)
+
+        self._stopped = False
+        self._worker = None
+        if threaded:
+            self._worker = threading.Thread(target=self._run, name="capm-bot-order-sender", daemon=True)
+            self._worker.start()
+
+    def submit(self, key, orders, intent=None):
+        """
+        Queue orders to be sent together, replacing any unsent entry with the same key
+        :param key: e.g. (market item, order side)
+        :param orders: list of orders sent in order (e.g. a cancel followed by its replacement)
+        :param intent: object passed to on_dropped if this entry is replaced before it is sent
+        """
+        with self._condition:
+            replaced_entry = self._queue.pop(key, None)
+            if replaced_entry is not None:
+                # keep cancels of stale resting quotes, drop the superseded new orders
+                orders = [order for order in replaced_entry.orders if self._is_cancel(order)] + list(orders)
+                self._count("orders_coalesced")
+
+            self._queue[key] = _QueuedIntent(orders, intent)
+            self._count("orders_queued")
+            self._condition.notify()
+
+        if replaced_entry is not None and self._on_dropped is not None:
+            self._on_dropped(replaced_entry.intent)
+
+    def flush(self):
+        """
+        Send queued orders now (inline mode, as far as the rate limit allows) or wake the worker (threaded mode)
+        """
+        if self._worker is not None:
+            with self._condition:
+                self._condition.notify()
+            return
+
+        while self._queue:
+            with self._condition:
+                key, entry = next(iter(self._queue.items()))
+                if not self._rate_limit.take(block=False, tokens=len(entry.orders)):
+                    return
+                self._queue.pop(key)
+            self._send(entry)
+
+    def clear(self):
+        """
+        Drop every queued entry without sending it (e.g. when the session changes) - on_dropped is called with the
+        intent of each
+        """
+        with self._condition:
+            dropped_entries = list(self._queue.values())
+            self._queue.clear()
+
+        if self._on_dropped is not None:
+            for entry in dropped_entries:
+                self._on_dropped(entry.intent)
+
+    def pending(self):
+        return len(self._queue)
+
+    def queued_intent(self, key):
+        """
+        :param key:
+        :return: intent of the unsent entry with this key (None if nothing is queued for the key)
+        """
+        with self._condition:
+            entry = self._queue.get(key)
+        return entry.intent if entry is not None else None
+
+    def stop(self, timeout=1.0):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+
+                batch = [self._queue.popitem(last=False)[1]
+                         for _ in range(min(self._batch_size, len(self._queue)))]
+
+            for entry in batch:
+                self._rate_limit.take(block=True, tokens=len(entry.orders))
+                self._send(entry)
+
+    def _send(self, entry):
+        if self._metrics is not None:
+            self._metrics.observe("order_queue_wait", time.perf_counter() - entry.queued_time)
+        for order in entry.orders:
+            self._send_order(order)
+            self._count("orders_sent")
+
+    def _count(self, name):
+        if self._metrics is not None:
+            self._metrics.count(name)
@@ -0,0 +1,125 @@
+"""
+Probability weighted payoff statistics for the CAPM Bot.
+
+State probabilities are no longer assumed to be uniform over four states: they can be given in the bot's config or
+appended to the market descriptions ("payoffs;probabilities", e.g. "1000,500,0,250;0.4,0.3,0.2,0.1"), and default to
+equally likely states. Mean payoffs and covariances are computed as probability weighted matrix products, streamed
+over blocks of states so that precomputation stays memory-bounded for payoff models with thousands of scenarios.
+"""
+import numpy as np
+
+# States processed per block - bounds the temporary memory used to O(securities x STATE_BLOCK_SIZE)
+STATE_BLOCK_SIZE = 4096
+
+
+def parse_description(description):
+    """
+    Parse a market description
+    :param description: "payoff,payoff,..." (cents), optionally followed by ";probability,probability,..."
+    :return: (list of payoffs, array of state probabilities or None)
+    """
+    payoffs, _, probabilities = description.partition(";")
+    payoffs = [int(a) for a in payoffs.split(",")]
+    if not probabilities.strip():
+        return payoffs, None
+
+    return payoffs, state_probabilities(len(payoffs), [float(a) for a in probabilities.split(",")])
+
+
+def state_probabilities(no_states, probabilities=None):
+    """
+    Validated state probability vector
+    :param no_states:
+    :param probabilities: probability (or relative weight) of each state, None for equally likely states
+    :return: array of probabilities summing to one
+    """
+    if probabilities is None:
+        return np.full(no_states, 1 / no_states)
+
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    if probabilities.shape != (no_states,):
+        raise ValueError(f"Expected {no_states} state probabilities, got {probabilities.shape[0]}")
+    if (probabilities < 0).any() or probabilities.sum() <= 0:
+        raise ValueError("State probabilities must be non-negative and not all zero")
+
+    return probabilities / probabilities.sum()
+
+
+def common_probabilities(no_states, described_probabilities):
+    """
+    State probabilities given by a set of market descriptions - they must all describe the same states
+    :param no_states:
+    :param described_probabilities: probabilities parsed from each description (None where a description gives
+                                    none, i.e. equally likely states)
+    :return: array of state probabilities
+    """
+    probabilities = state_probabilities(no_states)
+    for index, security_probabilities in enumerate(described_probabilities):
+        security_probabilities = state_probabilities(no_states, security_probabilities)
+        if index == 0:
+            probabilities = security_probabilities
+        elif not np.allclose(security_probabilities, probabilities):
+            raise ValueError("Market descriptions give inconsistent state probabilities")
+
+    return probabilities
+
+
+def weighted_statistics(payoff_matrix, probabilities, dtype=np.float64, block_size=STATE_BLOCK_SIZE):
+    """
+    Probability weighted mean payoffs and covariance matrix of payoffs
+    mu = P p, Sigma = (P - mu) diag(p) (P - mu)^T, accumulated over blocks of states
+    :param payoff_matrix: payoffs (securities x states)
+    :param probabilities: state probabilities
+    :param dtype: precision of the per block products (e.g. np.float32 for large state spaces) - blocks are
+                  accumulated in float64
+    :param block_size: states per block
+    :return: (mean payoffs, covariance matrix)
+    """
+    mean_payoffs = weighted_mean(payoff_matrix, probabilities, dtype, block_size)
+    covariance_matrix = weighted_covariance_rows(payoff_matrix, mean_payoffs, probabilities,
+                                                 np.arange(payoff_matrix.shape[0]), dtype, block_size)
+    return mean_payoffs, covariance_matrix
+
+
+def weighted_covariance_rows(payoff_matrix, mean_payoffs, probabilities, rows, dtype=np.float64,
+                             block_size=STATE_BLOCK_SIZE):
+    """
+    Rows of the probability weighted covariance matrix: Sigma[rows, :] = (P[rows] - mu[rows]) diag(p) (P - mu)^T
+    :param payoff_matrix: payoffs (securities x states)
+    :param mean_payoffs: probability weighted mean payoffs
+    :param probabilities: state probabilities
+    :param rows: security indices
+    :param dtype: precision of the per block products
+    :param block_size: states per block
+    :return: array (rows x securities)
+    """
+    rows = np.asarray(rows)
+    covariance_rows = np.zeros((len(rows), payoff_matrix.shape[0]))
+    mean_payoffs = mean_payoffs.astype(dtype)[:, np.newaxis]
+
+    for block in _state_blocks(payoff_matrix.shape[1], block_size):
+        centered_payoffs = payoff_matrix[:, block].astype(dtype, copy=False) - mean_payoffs
+        weighted_rows = centered_payoffs[rows] * probabilities[block].astype(dtype)
+        covariance_rows += weighted_rows @ centered_payoffs.T
+
+    return covariance_rows
+
+
+def weighted_mean(payoff_matrix, probabilities, dtype=np.float64, block_size=STATE_BLOCK_SIZE):
+    """
+    Probability weighted mean payoffs: mu = P p
+    :param payoff_matrix: payoffs (securities x states)
+    :param probabilities: state probabilities
+    :param dtype: precision of the per block products
+    :param block_size: states per block
+    :return: array of mean payoffs
+    """
+    mean_payoffs = np.zeros(payoff_matrix.shape[0])
+    for block in _state_blocks(payoff_matrix.shape[1], block_size):
+        mean_payoffs += payoff_matrix[:, block].astype(dtype, copy=False) @ probabilities[block].astype(dtype)
+    return mean_payoffs
+
+
+def _state_blocks(no_states, block_size):
+    for start in range(0, no_states, block_size):
+        yield slice(start, min(start + block_size, no_states))
@@ -0,0 +1,85 @@
+"""
+Event coalescing scheduler for the CAPM Bot's decision pass.
+
+Order updates are always applied to the bot's local state as they arrive, but the decision pass runs at most once per
+interval. Updates arriving in between are coalesced - the trailing pass runs from the first bot callback, or the bot's
+periodic task (which runs once the burst of updates has drained), after the interval has passed, on the latest state
+(latest-state-wins) rather than once per stale book state. Decision passes therefore always run on the thread
+delivering the marketplace client's callbacks, never on a thread of their own.
+"""
+import time
+
+
+class DecisionScheduler:
+    """
+    Runs a decision function at most once per min_interval, with a trailing run from the next callback or periodic
+    run_pending() after a burst of updates
+    """
+    def __init__(self, run_decision, min_interval=0.0, instrumentation=None):
+        """
+        :param run_decision: decision pass, run by notify()/ run_pending() on the caller's thread
+        :param min_interval: minimum seconds between decision passes (0 runs a pass for every notification)
+        :param instrumentation: optional Instrumentation
+        """
+        self._run_decision = run_decision
+        self.min_interval = min_interval
+        self._metrics = instrumentation
+
+        self._last_run = float("-inf")
+        self._pending_notifications = 0
+        self._pending_updates = 0
+        self._first_pending_time = None
+
+    def notify(self, updates=1):
+        """
+        Record that the state has changed and run the decision pass if the interval has passed, otherwise leave it
+        pending for run_pending()
+        :param updates: number of order updates applied
+        """
+        self._pending_notifications += 1
+        self._pending_updates += updates
+        if self._first_pending_time is None:
+            self._first_pending_time = time.monotonic()
+
+        self._observe("scheduler_pending_updates", self._pending_updates)
+        self.run_pending()
+
+    def run_pending(self):
+        """
+        Run the trailing decision pass if updates are pending and the interval has passed - called from every
+        callback and periodically, so coalesced updates are acted on even if the marketplace goes quiet
+        :return: True if the decision pass ran
+        """
+        if not self._pending_notifications or time.monotonic() < self._last_run + self.min_interval:
+            return False
+
+        self._run()
+        return True
+
+    def pending(self):
+        return self._pending_notifications
+
+    def cancel(self):
+        """
+        Drop pending updates (e.g. when the session closes)
+        """
+        self._pending_notifications = 0
+        self._pending_updates = 0
+        self._first_pending_time = None
+
+    def _run(self):
+        self._observe("notifications_per_decision", self._pending_notifications)
+        self._observe("decision_lag", time.monotonic() - self._first_pending_time)
+        if self._metrics is not None:
+            self._metrics.count("notifications_coalesced", self._pending_notifications - 1)
+
+        self._pending_notifications = 0
+        self._pending_updates = 0
+        self._first_pending_time = None
+        self._last_run = time.monotonic()
+
+        self._run_decision()
+
+    def _observe(self, name, value):
+        if self._metrics is not None:
+            self._metrics.observe(name, value)
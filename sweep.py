@@ -0,0 +1,201 @@
+"""
+Parallel parameter sweeps for the CAPM Bot.
+
+Runs a grid of CAPMBot configurations across a process pool, each replaying the same recorded (or synthetic) order
+stream through the offline market simulator, and tabulates final performance, fills and decision latency. Final
+performance of every configuration is evaluated together as one vectorised calculation over the holdings of all runs,
+both at each run's own risk penalty and at a common evaluation penalty so that runs can be compared.
+
+Usage:
+    python sweep.py --grid risk_penalty=0.002,0.007,0.02 --grid proactive_orders=1,3 --updates 5000
+    python sweep.py --markets markets.json --stream orders.jsonl --grid risk_penalty=0.005,0.01 --output sweep.csv
+
+Grid values are parsed as JSON (falling back to strings). markets.json is a list of market definitions:
+    [{"fm_id": 1, "item": "A", "description": "1000,500,0,250", "min_price": 0, "max_price": 1000,
+      "price_tick": 1, "max_units": 5}, ...]
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import market_sim
+import payoff_statistics
+from journal import order_stream, read_journal
+
+CONVERT_TO_DOLLARS = 1/100
+
+# Set in each worker process by _initialise_worker
+_markets = None
+_order_stream = None
+_cash = None
+
+
+def parameter_grid(grid):
+    """
+    Every combination of the grid's parameter values
+    :param grid: dict of parameter name -> list of values
+    :return: list of dicts of CAPMBot keyword arguments
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_configuration(bot_options):
+    """
+    Replay the worker's order stream into a fresh bot (runs in a worker process)
+    :param bot_options: CAPMBot keyword arguments
+    :return: dict of run results - final units are ordered as the markets
+    """
+    capm_bot_module = market_sim.load_capm_bot()
+    bot_options = dict({"async_orders": False, "max_orders_per_second": None}, **bot_options)
+    bot = capm_bot_module.CAPMBot("sweep", "", "", 0, **bot_options)
+
+    simulator = market_sim.MarketSimulator(bot, _markets, _cash)
+    start = time.perf_counter()
+    simulator.start()
+    simulator.replay(_order_stream)
+    replay_time = time.perf_counter() - start
+
+    decision_latency = bot._metrics.snapshot()["histograms"].get("decision_pass", {})
+    return {
+        "units": [simulator.units[market.fm_id] for market in _markets],
+        "cash": simulator.cash,
+        "fills": simulator.fills,
+        "orders_sent": simulator.orders_sent,
+        "orders_rejected": simulator.orders_rejected,
+        "decision_p50_ms": decision_latency.get("p50", 0.0) * 1000,
+        "decision_p99_ms": decision_latency.get("p99", 0.0) * 1000,
+        "replay_s": replay_time,
+    }
+
+
+def evaluate_performance(markets, units, cash, risk_penalties):
+    """
+    Performance of many portfolios at once: cash + mu . x - b * x^T Sigma x for every row of units
+    :param markets: list of Market
+    :param units: array (runs x securities), ordered as the markets
+    :param cash: array of cash (cents) of each run
+    :param risk_penalties: risk penalty of each run (or a single penalty)
+    :return: array of performance (dollars)
+    """
+    descriptions = [payoff_statistics.parse_description(market.description) for market in markets]
+    payoff_matrix = np.array([payoffs for payoffs, probabilities in descriptions], dtype=float) * CONVERT_TO_DOLLARS
+    probabilities = payoff_statistics.common_probabilities(payoff_matrix.shape[1],
+                                                           [probabilities for payoffs, probabilities in descriptions])
+    mean_payoffs, covariance_matrix = payoff_statistics.weighted_statistics(payoff_matrix, probabilities)
+
+    units = np.asarray(units, dtype=float)
+    expected_payoffs = np.asarray(cash) * CONVERT_TO_DOLLARS + units @ mean_payoffs
+    payoff_variances = np.einsum("ij,jk,ik->i", units, covariance_matrix, units)
+    return expected_payoffs - np.asarray(risk_penalties) * payoff_variances
+
+
+def sweep(markets, order_events, configurations, cash=100000, processes=None, evaluation_penalty=0.007):
+    """
+    Run every configuration against the same order stream in a process pool
+    :param markets: list of Market
+    :param order_events: list of event batches (see MarketSimulator.apply_events)
+    :param configurations: list of dicts of CAPMBot keyword arguments
+    :param cash: starting cash (cents)
+    :param processes: number of worker processes (defaults to the number of CPUs)
+    :param evaluation_penalty: common risk penalty runs are also evaluated at
+    :return: list of result rows (configuration and results)
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_initialise_worker,
+                             initargs=(markets, order_events, cash)) as executor:
+        results = list(executor.map(run_configuration, configurations))
+
+    units = np.array([result.pop("units") for result in results], dtype=float).reshape(len(results), len(markets))
+    final_cash = np.array([result.pop("cash") for result in results], dtype=float)
+    risk_penalties = [configuration.get("risk_penalty", 0.007) for configuration in configurations]
+
+    performance = evaluate_performance(markets, units, final_cash, risk_penalties)
+    common_performance = evaluate_performance(markets, units, final_cash, evaluation_penalty)
+
+    return [dict(configuration, performance=performance[run], common_performance=common_performance[run], **result)
+            for run, (configuration, result) in enumerate(zip(configurations, results))]
+
+
+def load_markets(path):
+    with open(path) as markets_file:
+        return [market_sim.Market(**market) for market in json.load(markets_file)]
+
+
+def _initialise_worker(markets, order_events, cash):
+    global _markets, _order_stream, _cash
+    _markets, _order_stream, _cash = markets, order_events, cash
+
+
+def _parse_grid(grid_arguments):
+    grid = {}
+    for grid_argument in grid_arguments:
+        name, _, values = grid_argument.partition("=")
+        grid[name.strip()] = [_parse_value(value) for value in values.split(",")]
+    return grid
+
+
+def _parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep CAPM Bot parameters against a recorded order stream")
+    parser.add_argument("--grid", action="append", default=[], metavar="NAME=V1,V2,...",
+                        help="CAPMBot keyword argument and the values swept (repeatable)")
+    parser.add_argument("--markets", help="JSON market definitions (required for recorded streams)")
+    parser.add_argument("--stream", help="recorded order stream (JSON lines, see market_sim.save_order_stream)")
+    parser.add_argument("--journal", help="bot journal to replay the public orders of (see journal.py)")
+    parser.add_argument("--securities", type=int, default=10, help="synthetic markets, if no stream is given")
+    parser.add_argument("--updates", type=int, default=2000, help="synthetic order updates, if no stream is given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cash", type=int, default=100000, help="starting cash (cents)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--evaluation-penalty", type=float, default=0.007)
+    parser.add_argument("--output", help="CSV file the results table is written to")
+    args = parser.parse_args()
+
+    grid = _parse_grid(args.grid) or {"risk_penalty": [0.002, 0.005, 0.007, 0.01, 0.02]}
+
+    if args.stream or args.journal:
+        if not args.markets:
+            parser.error("--markets is required with --stream/ --journal")
+        markets = load_markets(args.markets)
+        order_events = market_sim.load_order_stream(args.stream) if args.stream else \
+            list(order_stream(read_journal(args.journal)))
+    else:
+        markets = load_markets(args.markets) if args.markets else \
+            market_sim.synthetic_markets(args.securities, seed=args.seed)
+        order_events = list(market_sim.synthetic_order_stream(markets, args.updates, seed=args.seed))
+
+    configurations = parameter_grid(grid)
+    start = time.perf_counter()
+    rows = sweep(markets, order_events, configurations, args.cash, args.processes, args.evaluation_penalty)
+    print(f"{len(rows)} runs in {time.perf_counter() - start:.1f}s")
+
+    columns = list(grid) + ["performance", "common_performance", "fills", "orders_sent", "orders_rejected",
+                            "decision_p50_ms", "decision_p99_ms", "replay_s"]
+    print(" ".join(f"{column:>18}" for column in columns))
+    for row in sorted(rows, key=lambda row: -row["common_performance"]):
+        print(" ".join(f"{row[column]:>18.4f}" if isinstance(row[column], float) else f"{str(row[column]):>18}"
+                       for column in columns))
+
+    if args.output:
+        with open(args.output, "w", newline="") as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Tests for the bot host, run offline against the market simulator's fmclient stand-ins.
+
+Usage:
+    python -m pytest -q
+"""
+import multiprocessing
+import time
+
+import numpy as np
+import pytest
+
+import bot_host
+import journal
+import market_sim
+
+capm_bot_module = market_sim.load_capm_bot()
+
+
+def journal_holdings_and_wait(bot):
+    """
+    Stand-in for CAPMBot.run - buffers a journal record, then waits to be stopped
+    """
+    bot._journal.record_holdings(market_sim.Holding(100000, 100000, {}))
+    while True:
+        time.sleep(0.01)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="the worker must inherit the stand-ins")
+def test_terminated_worker_writes_its_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(capm_bot_module.CAPMBot, "run", journal_holdings_and_wait)
+    path = str(tmp_path / "bot.journal")
+    bot_config = {"account": "test", "email": "", "password": "", "marketplace_id": 0, "journal": path}
+
+    worker = multiprocessing.Process(target=bot_host.run_bot, args=(bot_config,))
+    worker.start()
+    time.sleep(0.5)
+    worker.terminate()
+    worker.join(5)
+
+    assert worker.exitcode == 0
+    assert journal.read_journal(path)["kind"].tolist() == [journal.CASH]
+
+
+def test_bot_uses_matching_shared_statistics():
+    markets = market_sim.synthetic_markets(5, seed=0)
+    payoffs = {market.item: [int(payoff) for payoff in market.description.split(",")] for market in markets}
+    shared_statistics = bot_host.SharedStatistics(dict(reversed(list(payoffs.items()))))
+    try:
+        memory, statistics = bot_host.attach_shared_statistics(shared_statistics.spec())
+        securities, shared_payoffs, probabilities, mean_payoffs, covariance_matrix = statistics
+        assert not covariance_matrix.flags.writeable
+
+        bot = capm_bot_module.CAPMBot("test", "", "", 0, shared_statistics=statistics)
+        simulator = market_sim.MarketSimulator(bot, markets, 100000)
+        simulator.start()
+
+        # the bot takes the shared security order and statistics rather than computing its own
+        assert bot._state.securities == securities
+        assert bot._state.payoff_matrix is None
+        assert bot._state.covariance_matrix is covariance_matrix
+        assert simulator.performance(bot._risk_penalty) == pytest.approx(bot._calculate_current_performance())
+
+        # once the payoffs no longer match, the bot computes private statistics
+        markets[2].description = "1000,0,250,750"
+        bot.received_session_info(market_sim.Session(is_open=False))
+        bot.received_session_info(market_sim.Session(is_open=True))
+        assert bot._state.payoff_matrix is not None
+        assert bot._state.covariance_matrix is not covariance_matrix
+        np.testing.assert_array_equal(shared_payoffs, [payoffs[security] for security in securities])
+
+        del statistics, shared_payoffs, probabilities, mean_payoffs, covariance_matrix, bot, simulator
+        memory.close()
+    finally:
+        shared_statistics.close()
+
+    with pytest.raises(FileNotFoundError):
+        bot_host.attach_shared_statistics(shared_statistics.spec())
+
+
+def test_shared_statistics_with_different_probabilities_are_not_used():
+    markets = market_sim.synthetic_markets(4, seed=0)
+    payoffs = {market.item: [int(payoff) for payoff in market.description.split(",")] for market in markets}
+    shared_statistics = bot_host.SharedStatistics(payoffs, [0.4, 0.3, 0.2, 0.1])
+    try:
+        memory, statistics = bot_host.attach_shared_statistics(shared_statistics.spec())
+        bot = capm_bot_module.CAPMBot("test", "", "", 0, shared_statistics=statistics)
+        market_sim.MarketSimulator(bot, markets, 100000).start()
+        assert bot._state.payoff_matrix is not None
+
+        del statistics, bot
+        memory.close()
+    finally:
+        shared_statistics.close()
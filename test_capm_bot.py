@@ -0,0 +1,458 @@
+"""
+Tests for the CAPM Bot, run offline against the market simulator's fmclient stand-ins.
+
+Usage:
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+import market_sim
+from payoff_statistics import weighted_statistics
+
+capm_bot_module = market_sim.load_capm_bot()
+CAPMBot = capm_bot_module.CAPMBot
+OrderStatus = capm_bot_module.OrderStatus
+OrderSide = market_sim.OrderSide
+CONVERT_TO_DOLLARS = capm_bot_module.CONVERT_TO_DOLLARS
+
+
+def start_bot(no_securities=6, cash=100000, seed=0, **bot_options):
+    """
+    Fresh bot with its session open in a simulator (orders sent inline, no rate limits)
+    :return: (bot, simulator)
+    """
+    markets = market_sim.synthetic_markets(no_securities, seed=seed)
+    bot_options = dict({"max_orders_per_second": None, "max_cancels_per_second": None}, **bot_options)
+    bot = CAPMBot("test", "", "", 0, **bot_options)
+    simulator = market_sim.MarketSimulator(bot, markets, cash)
+    simulator.start()
+    return bot, simulator
+
+
+def set_holdings(bot, units, cash=100000):
+    """
+    Deliver settled holdings (units ordered by the security index) straight to the bot
+    """
+    assets = {market: market_sim.Asset(int(units[bot._state.index[market.item]]),
+                                       int(units[bot._state.index[market.item]]))
+              for market in bot.markets.values()}
+    bot.received_holdings(market_sim.Holding(cash, cash, assets))
+
+
+def own_order_update(current_order, units, traded=False, cancelled=False):
+    """
+    Order update for one of our own orders, as passed to received_orders
+    """
+    order = current_order._create_order()
+    order.fm_id = 1
+    order.mine = True
+    order.units = units
+    order.is_pending = units > 0 and not cancelled
+    order.is_cancelled = cancelled
+    order.traded_order = market_sim.Order() if traded else None
+    return order
+
+
+@pytest.mark.parametrize("probabilities", [None, [0.4, 0.3, 0.2, 0.1]])
+def test_reference_performance_matches_vectorised(probabilities):
+    bot, simulator = start_bot(state_probabilities=probabilities)
+    rng = np.random.default_rng(1)
+
+    for _ in range(20):
+        units = rng.integers(-5, 10, len(bot._state.securities))
+        cash = float(rng.integers(0, 200000)) * CONVERT_TO_DOLLARS
+        reference = bot._calculate_performance_reference(dict(zip(bot._state.securities, units.tolist())), cash)
+        assert bot._calculate_performance(units.astype(float), cash) == pytest.approx(reference, rel=1e-12)
+
+
+def test_reference_performance_matches_simulator_after_replay():
+    bot, simulator = start_bot()
+    simulator.replay(market_sim.synthetic_order_stream(list(simulator.markets.values()), 300))
+
+    reference = bot._calculate_performance_reference(bot.units_holdings, bot.cash * CONVERT_TO_DOLLARS)
+    assert bot._calculate_current_performance() == pytest.approx(reference)
+    assert simulator.performance(bot._risk_penalty) == pytest.approx(reference)
+
+
+@pytest.mark.parametrize("probabilities", [None, [0.1, 0.2, 0.3, 0.4]])
+def test_incremental_covariance_matches_full_recompute(probabilities):
+    bot, simulator = start_bot(no_securities=8, state_probabilities=probabilities)
+    state = bot._state
+    snapshot = state.snapshot()
+    covariance_matrix = state.covariance_matrix.copy()
+
+    # change the payoffs of two securities while the market is closed
+    markets = list(simulator.markets.values())
+    markets[1].description = "1000,0,250,750"
+    markets[5].description = "100,900,400,600"
+    bot.received_session_info(market_sim.Session(is_open=False))
+    bot.received_session_info(market_sim.Session(is_open=True))
+
+    # only the changed rows/ columns were re-calculated, into new arrays - the snapshot is unchanged
+    changed_indices = [state.index[markets[1].item], state.index[markets[5].item]]
+    unchanged_indices = np.setdiff1d(np.arange(len(state.securities)), changed_indices)
+    np.testing.assert_array_equal(state.covariance_matrix[np.ix_(unchanged_indices, unchanged_indices)],
+                                  covariance_matrix[np.ix_(unchanged_indices, unchanged_indices)])
+    np.testing.assert_array_equal(snapshot.covariance_matrix, covariance_matrix)
+    assert snapshot.payoff_matrix is not state.payoff_matrix
+    assert state.payoffs[state.index[markets[1].item]].tolist() == [1000, 0, 250, 750]
+
+    mean_payoffs, covariance_matrix = weighted_statistics(state.payoffs * CONVERT_TO_DOLLARS, state.probabilities)
+    np.testing.assert_allclose(state.mean_payoffs, mean_payoffs, rtol=1e-12)
+    np.testing.assert_allclose(state.covariance_matrix, covariance_matrix, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(bot.covariance_holdings, covariance_matrix @ state.units)
+
+
+def tick_by_tick_price_search(bot, market_id, best_price, order_side, units=1):
+    """
+    Price search as it was before reservation prices - step one tick at a time away from the best bid/ ask until the
+    trade improves performance
+    """
+    market = bot._market_ids[market_id]
+    item_index = bot._state.index[market.item]
+    direction = 1 if order_side == OrderSide.BUY else -1
+    price = best_price["best_bid"] if order_side == OrderSide.BUY else best_price["best_ask"]
+
+    while market.min_price <= price <= market.max_price:
+        if bot._performance_deltas(item_index, direction, price, units) > 0:
+            return price
+        price -= direction * market.price_tick
+
+    return None
+
+
+@pytest.mark.parametrize("units", [1, 3])
+def test_reservation_price_search_matches_tick_by_tick_search(units):
+    bot, simulator = start_bot(no_securities=5)
+    rng = np.random.default_rng(2)
+
+    for _ in range(20):
+        set_holdings(bot, rng.integers(-3, 8, len(bot._state.securities)))
+        for market_id, market in bot._market_ids.items():
+            best_bid, best_ask = sorted(rng.integers(market.min_price, market.max_price + 1, 2).tolist())
+            best_price = {"best_bid": best_bid, "best_ask": best_ask}
+            for order_side in (OrderSide.BUY, OrderSide.SELL):
+                order_price = bot._reservation_price_search(market_id, best_price, order_side, units)
+                tick_price = tick_by_tick_price_search(bot, market_id, best_price, order_side, units)
+                if order_price == tick_price:
+                    continue
+
+                # the searches may only disagree when the reservation price is exactly on a tick, where the
+                # performance change is zero up to rounding
+                assert abs(order_price - tick_price) == market.price_tick
+                direction = 1 if order_side == OrderSide.BUY else -1
+                assert bot._performance_deltas(bot._state.index[market.item], direction, tick_price, units) == \
+                    pytest.approx(0, abs=1e-9)
+
+
+def test_own_order_transitions():
+    bot, simulator = start_bot()
+    market = next(iter(bot.markets.values()))
+    tracker = bot._own_orders
+
+    accepted_order = capm_bot_module._CurrentOrder(100, OrderSide.BUY, market, 2)
+    tracker.add(accepted_order)
+    assert accepted_order.order_status == OrderStatus.SENT
+    assert tracker.outstanding(market.item) == 1
+
+    assert tracker.transition(accepted_order.ref, OrderStatus.ACCEPTED) is accepted_order
+    assert tracker.transition(accepted_order.ref, OrderStatus.SENT) is None
+
+    bot._update_trade_status(own_order_update(accepted_order, 0, traded=True))
+    assert accepted_order.order_status == OrderStatus.TRADED
+    assert tracker.outstanding(market.item) == 0
+    assert accepted_order.ref in bot.traded_order_dict
+
+    # an accept arriving after the order traded is ignored
+    assert tracker.transition(accepted_order.ref, OrderStatus.ACCEPTED) is None
+
+    rejected_order = capm_bot_module._CurrentOrder(101, OrderSide.SELL, market)
+    tracker.add(rejected_order)
+    tracker.transition(rejected_order.ref, OrderStatus.REJECTED)
+    assert tracker.get(rejected_order.ref) is None
+    assert tracker.outstanding(market.item) == 0
+
+    cancelled_order = capm_bot_module._CurrentOrder(102, OrderSide.SELL, market)
+    tracker.add(cancelled_order)
+    tracker.transition(cancelled_order.ref, OrderStatus.ACCEPTED)
+    tracker.request_cancel(cancelled_order.ref)
+    bot._update_trade_status(own_order_update(cancelled_order, 1, cancelled=True))
+    assert cancelled_order.order_status == OrderStatus.CANCELLED
+    assert tracker.get(cancelled_order.ref) is None
+    assert not tracker.cancel_requested(cancelled_order.ref)
+
+
+def test_partly_traded_order_stays_resting_with_remaining_units():
+    bot, simulator = start_bot()
+    market = next(iter(bot.markets.values()))
+    tracker = bot._own_orders
+
+    current_order = capm_bot_module._CurrentOrder(100, OrderSide.BUY, market, 5)
+    tracker.add(current_order)
+    tracker.transition(current_order.ref, OrderStatus.ACCEPTED)
+
+    # BUY 5 @ 100 filled for 2 => 3 units still resting
+    bot._update_trade_status(own_order_update(current_order, 3, traded=True))
+    assert current_order.order_status == OrderStatus.ACCEPTED
+    assert current_order.units == 3
+    assert tracker.outstanding(market.item) == 1
+    assert [order for value, order in bot._resting_quote_values(market.item)] == [current_order]
+
+    bot._update_trade_status(own_order_update(current_order, 0, traded=True))
+    assert current_order.order_status == OrderStatus.TRADED
+    assert tracker.outstanding(market.item) == 0
+
+
+def test_partly_traded_order_in_simulator():
+    bot, simulator = start_bot(proactive_orders=0)
+    market = next(iter(simulator.markets.values()))
+    order_price = int(bot.reservation_bids[bot._state.index[market.item]]) - 50
+
+    current_order = capm_bot_module._CurrentOrder(order_price, OrderSide.BUY, market, 5)
+    bot._send_current_order(current_order)
+    bot._order_pipeline.flush()
+    simulator._process_outbox()
+    assert current_order.order_status == OrderStatus.ACCEPTED
+    assert current_order.fm_id is not None
+
+    simulator.apply_events([{"action": "new", "id": 1, "market": market.fm_id, "side": "SELL", "price": order_price,
+                             "units": 2}])
+    assert simulator.units[market.fm_id] == 2
+    assert current_order.order_status == OrderStatus.ACCEPTED
+    assert current_order.units == 3
+    assert bot._own_orders.outstanding(market.item) == 1
+
+
+def public_order(market, fm_id, order_side, price, units=1):
+    """
+    Pending public order, registered with the simulator's Order.all()
+    """
+    order = market_sim.Order.create_new(market)
+    order.fm_id = fm_id
+    order.order_side = order_side
+    order.price = price
+    order.units = units
+    order.is_pending = True
+    market_sim.Order.all()[fm_id] = order
+    return order
+
+
+def test_rebalance_accounts_for_outstanding_orders():
+    bot, simulator = start_bot(proactive_orders=0)
+    market = next(iter(simulator.markets.values()))
+    order_price = max(market.min_price + 1, int(bot.reservation_bids[bot._state.index[market.item]]) - 100)
+    sell_order = public_order(market, 1, OrderSide.SELL, order_price, 5)
+
+    # the marketplace has not processed any of our orders between the decision passes
+    for _ in range(3):
+        bot.received_orders([sell_order])
+
+    bought_units = sum(order.units for order in simulator._outbox if order.order_side == OrderSide.BUY)
+    assert 0 < bought_units <= 5
+    assert bot._own_orders.outstanding(market.item) == 1
+
+
+def test_queued_order_is_replaced_when_market_is_full():
+    bot, simulator = start_bot(proactive_orders=0, max_orders_per_second=10)
+    market = next(iter(simulator.markets.values()))
+    tracker = bot._own_orders
+
+    # the market is full with resting orders that cannot be cancelled, and a buy order held back by the rate limit
+    bot._cancel_rate_limit = capm_bot_module.TokenBucket(1, 1)
+    bot._cancel_rate_limit.take()
+    for _ in range(market.max_units - 1):
+        resting_order = capm_bot_module._CurrentOrder(market.min_price + 1, OrderSide.SELL, market)
+        tracker.add(resting_order)
+        tracker.transition(resting_order.ref, OrderStatus.ACCEPTED)
+
+    bot._order_pipeline._rate_limit = capm_bot_module.TokenBucket(1, 1)
+    bot._order_pipeline._rate_limit.take()
+    stale_order = capm_bot_module._CurrentOrder(100, OrderSide.BUY, market)
+    bot._send_current_order(stale_order)
+    assert tracker.outstanding(market.item) == market.max_units
+
+    # a new buy order replaces the queued one rather than being blocked by it
+    assert bot._take_performance_improvement(market, OrderSide.BUY, 101)
+    new_order = bot._order_pipeline.queued_intent((market.item, OrderSide.BUY))
+    assert new_order.price == 101
+    assert stale_order.order_status == OrderStatus.CANCELLED
+    assert tracker.outstanding(market.item) == market.max_units
+    assert bot._order_pipeline.pending() == 1
+
+
+def test_state_probabilities_follow_the_market_descriptions():
+    markets = market_sim.synthetic_markets(4, seed=0)
+    for market in markets:
+        market.description += ";0.4,0.3,0.2,0.1"
+    bot = CAPMBot("test", "", "", 0)
+    simulator = market_sim.MarketSimulator(bot, markets, 100000)
+    simulator.start()
+    np.testing.assert_allclose(bot._state.probabilities, [0.4, 0.3, 0.2, 0.1])
+
+    # descriptions without probabilities describe equally likely states
+    for market in markets:
+        market.description = market.description.partition(";")[0]
+    markets[1].description = "1000,0,250,750"
+    bot.received_session_info(market_sim.Session(is_open=False))
+    bot.received_session_info(market_sim.Session(is_open=True))
+    bot.received_holdings(simulator.holdings())
+    np.testing.assert_allclose(bot._state.probabilities, 0.25)
+    assert simulator.performance(bot._risk_penalty) == pytest.approx(bot._calculate_current_performance())
+
+    markets[2].description += ";0.4,0.3,0.2,0.1"
+    with pytest.raises(ValueError):
+        bot.received_session_info(market_sim.Session(is_open=True))
+
+
+def test_change_in_number_of_states_recomputes_statistics():
+    bot, simulator = start_bot(no_securities=4)
+    markets = list(simulator.markets.values())
+
+    for market_index, market in enumerate(markets):
+        market.description = ",".join(str(100 * (market_index + state)) for state in range(5))
+    bot.received_session_info(market_sim.Session(is_open=False))
+    bot.received_session_info(market_sim.Session(is_open=True))
+    bot.received_holdings(simulator.holdings())
+
+    state = bot._state
+    assert state.payoffs.shape == (4, 5)
+    mean_payoffs, covariance_matrix = weighted_statistics(state.payoffs * CONVERT_TO_DOLLARS, state.probabilities)
+    np.testing.assert_allclose(state.probabilities, 0.2)
+    np.testing.assert_allclose(state.mean_payoffs, mean_payoffs)
+    np.testing.assert_allclose(state.covariance_matrix, covariance_matrix, atol=1e-12)
+    assert simulator.performance(bot._risk_penalty) == pytest.approx(bot._calculate_current_performance())
+
+    # every description must describe the same number of states
+    markets[0].description = "100,200,300,400"
+    with pytest.raises(ValueError):
+        bot.received_session_info(market_sim.Session(is_open=True))
+
+
+def test_local_order_book_best_orders():
+    market = market_sim.Market(1, "A", "100,200")
+    order_book = capm_bot_module._LocalOrderBook()
+    bids = [public_order(market, fm_id, OrderSide.BUY, price) for fm_id, price in ((1, 100), (2, 105), (3, 103))]
+    asks = [public_order(market, fm_id, OrderSide.SELL, price) for fm_id, price in ((4, 120), (5, 110))]
+    own_bid = public_order(market, 6, OrderSide.BUY, 108)
+    own_bid.mine = True
+    own_bid.ref = "own-bid"
+    for order in bids + asks + [own_bid]:
+        order_book.update(order)
+
+    assert order_book.best_bid_ask("A") == (own_bid, asks[1])
+    assert order_book.best_bid_ask("A", include_mine=False) == (bids[1], asks[1])
+    assert sorted(order.fm_id for order in order_book.best_public_orders()) == [2, 5]
+    assert order_book.get("own-bid") is own_bid
+
+    # orders no longer pending are removed, and a pending update replaces the order
+    bids[1].is_pending = False
+    order_book.update(bids[1])
+    asks[1].price = 125
+    order_book.update(asks[1])
+    own_bid.is_cancelled = True
+    own_bid.is_pending = False
+    order_book.update(own_bid)
+
+    assert order_book.best_bid_ask("A") == (bids[2], asks[0])
+    assert order_book.get("own-bid") is None
+    assert len(order_book) == 4
+
+
+def test_order_book_side_is_compacted():
+    market = market_sim.Market(1, "A", "100,200")
+    book_side = capm_bot_module._OrderBookSide(OrderSide.BUY)
+    for fm_id in range(100):
+        book_side.add(fm_id, public_order(market, fm_id, OrderSide.BUY, 100 + fm_id % 7))
+
+    # removing orders that are not at the top of the heap leaves stale entries until the heap is compacted
+    for fm_id in range(90):
+        book_side.remove(fm_id)
+        assert len(book_side._heap) <= 2 * len(book_side) + 1
+
+    assert len(book_side) == 10
+    assert book_side.best().price == max(100 + fm_id % 7 for fm_id in range(90, 100))
+
+
+def rest_order(bot, simulator, market, order_side, price, units=1):
+    """
+    Send one of our orders through the bot and let the simulator accept it
+    :return: _CurrentOrder
+    """
+    current_order = capm_bot_module._CurrentOrder(price, order_side, market, units)
+    bot._send_current_order(current_order)
+    bot._order_pipeline.flush()
+    simulator._process_outbox()
+    return current_order
+
+
+def test_harmful_quote_is_cancelled_and_repriced():
+    bot, simulator = start_bot(proactive_orders=0)
+    item_index = int(np.argmax(bot.reservation_bids))
+    market = bot._market_ids[bot._index_market_ids[item_index]]
+    resting_order = rest_order(bot, simulator, market, OrderSide.BUY, int(bot.reservation_bids[item_index]) - 1)
+    assert resting_order.order_status == OrderStatus.ACCEPTED
+
+    # holding many more units lowers the reservation bid below the quote
+    units = np.zeros(len(bot._state.securities), dtype=int)
+    units[item_index] = 30
+    set_holdings(bot, units)
+    assert bot.reservation_bids[item_index] < resting_order.price
+
+    cancel_order, repriced_order = simulator._outbox
+    assert cancel_order.order_type == market_sim.OrderType.CANCEL and cancel_order.fm_id == resting_order.fm_id
+    assert bot._own_orders.cancel_requested(resting_order.ref)
+    assert repriced_order.order_side == OrderSide.BUY
+    assert repriced_order.price < bot.reservation_bids[item_index]
+
+    simulator._process_outbox()
+    assert resting_order.order_status == OrderStatus.CANCELLED
+    assert bot._own_orders.outstanding(market.item) == 1
+
+
+def test_least_valuable_quote_is_replaceable():
+    bot, simulator = start_bot(proactive_orders=0, max_cancels_per_second=1)
+    item_index = int(np.argmax(bot.reservation_bids))
+    market = bot._market_ids[bot._index_market_ids[item_index]]
+    reservation_bid = int(bot.reservation_bids[item_index])
+    rest_order(bot, simulator, market, OrderSide.BUY, reservation_bid - 2)
+    least_valuable_order = rest_order(bot, simulator, market, OrderSide.BUY, reservation_bid - 1)
+
+    # a new order is only worth a cancel if it improves performance more than the least valuable quote
+    assert bot._replaceable_resting_order(market.item, OrderSide.BUY, reservation_bid) is None
+    replaceable_order = bot._replaceable_resting_order(market.item, OrderSide.BUY, reservation_bid - 10)
+    assert replaceable_order.ref == least_valuable_order.ref
+
+    bot._cancel_rate_limit.take()
+    assert bot._replaceable_resting_order(market.item, OrderSide.BUY, reservation_bid - 10) is None
+
+
+def test_proactive_opportunities_are_ranked_by_improvement():
+    bot, simulator = start_bot(proactive_orders=0)
+    simulator.replay(market_sim.synthetic_order_stream(list(simulator.markets.values()), 100))
+    opportunities = bot._rank_proactive_opportunities()
+    assert opportunities
+
+    performance_deltas = [performance_delta for performance_delta, market_id, order_side, price in opportunities]
+    assert performance_deltas == sorted(performance_deltas, reverse=True)
+    assert all(performance_delta > 0 for performance_delta in performance_deltas)
+
+    # each quote is at the closest performance improving price to the best bid/ ask (up to a tick where the
+    # reservation price is exactly on a tick)
+    for performance_delta, market_id, order_side, order_price in opportunities:
+        best_prices = bot._get_best_bid_ask_price(market_id, bot._market_ids[market_id].item)
+        tick_price = tick_by_tick_price_search(bot, market_id, best_prices, order_side)
+        assert abs(order_price - tick_price) <= bot._market_ids[market_id].price_tick
+
+
+@pytest.mark.parametrize("proactive_orders", [0, 2])
+def test_proactive_orders_per_decision_pass(proactive_orders):
+    bot, simulator = start_bot(proactive_orders=proactive_orders)
+    simulator._outbox.clear()
+    opportunities = bot._rank_proactive_opportunities()
+    assert len(opportunities) >= 2
+
+    bot._proactive_mode()
+    bot._order_pipeline.flush()
+    assert [(order.order_side, order.price) for order in simulator._outbox] == \
+        [(order_side, order_price) for _, _, order_side, order_price in opportunities[:proactive_orders]]
@@ -0,0 +1,77 @@
+"""
+Tests for the order journal, run offline against the market simulator.
+
+Usage:
+    python -m pytest -q
+"""
+import numpy as np
+
+import journal
+import market_sim
+
+capm_bot_module = market_sim.load_capm_bot()
+
+
+def journalled_replay(path, no_updates=500):
+    """
+    Replay a synthetic order stream into a bot writing a journal
+    :return: simulator
+    """
+    markets = market_sim.synthetic_markets(4, seed=1)
+    order_journal = journal.OrderJournal(path)
+    bot = capm_bot_module.CAPMBot("test", "", "", 0, max_orders_per_second=None, max_cancels_per_second=None,
+                                  journal=order_journal)
+    simulator = market_sim.MarketSimulator(bot, markets, 100000)
+    simulator.start()
+    simulator.replay(market_sim.synthetic_order_stream(markets, no_updates, seed=2))
+    simulator.close()
+    order_journal.close()
+    return simulator
+
+
+def test_journal_round_trip(tmp_path):
+    path = str(tmp_path / "bot.journal")
+    simulator = journalled_replay(path)
+    records = journal.read_journal(path)
+
+    assert set(np.unique(records["kind"])) == {journal.ORDER, journal.HOLDING, journal.CASH, journal.SESSION,
+                                               journal.OWN_ORDER}
+    assert records["batch"][-1] == records["batch"].max()
+
+    # accepted own orders are journalled with their fm id, and joined to their order updates by ref
+    own_orders = records[records["kind"] == journal.OWN_ORDER]
+    accepted_orders = own_orders[own_orders["status"] == capm_bot_module.OrderStatus.ACCEPTED.value]
+    assert len(accepted_orders) and (accepted_orders["fm_id"] >= simulator.OWN_ORDER_ID_START).all()
+    own_order_updates = records[(records["kind"] == journal.ORDER) & (records["flags"] & journal.MINE != 0)]
+    assert np.isin(own_order_updates["ref"], own_orders["ref"]).all()
+
+
+def test_order_stream_replays_fills_against_our_quotes(tmp_path):
+    path = str(tmp_path / "bot.journal")
+    simulator = journalled_replay(path)
+    assert simulator.fills > 0
+
+    # replaying the journalled public orders into a fresh bot trades the same units
+    markets = market_sim.synthetic_markets(4, seed=1)
+    bot = capm_bot_module.CAPMBot("test", "", "", 0, max_orders_per_second=None, max_cancels_per_second=None)
+    replay_simulator = market_sim.MarketSimulator(bot, markets, 100000)
+    replay_simulator.start()
+    replay_simulator.replay(journal.order_stream(journal.read_journal(path)))
+    assert replay_simulator.fills == simulator.fills
+
+
+def test_partly_written_record_is_dropped(tmp_path):
+    path = str(tmp_path / "bot.journal")
+    order_journal = journal.OrderJournal(path)
+    order_journal.record_session(True)
+    order_journal.close()
+
+    with open(path, "ab") as journal_file:
+        journal_file.write(b"partial")
+    assert len(journal.read_journal(path)) == 1
+
+    order_journal = journal.OrderJournal(path)
+    order_journal.record_session(False)
+    order_journal.close()
+    records = journal.read_journal(path)
+    assert records["flags"].tolist() == [journal.SESSION_OPEN, 0]
@@ -0,0 +1,110 @@
+"""
+Tests for the outbound order pipeline and its rate limiter.
+
+Usage:
+    python -m pytest -q
+"""
+import pytest
+
+import order_pipeline
+from order_pipeline import OrderPipeline, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(order_pipeline, "time", fake_clock)
+    return fake_clock
+
+
+def is_cancel(order):
+    return order.startswith("cancel")
+
+
+def test_unsent_entry_is_replaced_keeping_its_cancels(clock):
+    sent_orders = []
+    dropped_intents = []
+    pipeline = OrderPipeline(sent_orders.append, max_orders_per_second=None, on_dropped=dropped_intents.append,
+                             is_cancel=is_cancel)
+
+    pipeline.submit(("A", "BUY"), ["cancel 1", "buy 100"], intent="first")
+    pipeline.submit(("A", "SELL"), ["sell 120"], intent="sell")
+    pipeline.submit(("A", "BUY"), ["buy 101"], intent="second")
+    assert pipeline.pending() == 2
+    assert pipeline.queued_intent(("A", "BUY")) == "second"
+    assert pipeline.queued_intent(("B", "BUY")) is None
+    assert dropped_intents == ["first"]
+
+    # the replaced entry goes to the back of the queue
+    pipeline.flush()
+    assert sent_orders == ["sell 120", "cancel 1", "buy 101"]
+    assert pipeline.pending() == 0
+
+
+def test_clear_drops_every_entry(clock):
+    sent_orders = []
+    dropped_intents = []
+    pipeline = OrderPipeline(sent_orders.append, max_orders_per_second=None, on_dropped=dropped_intents.append)
+
+    pipeline.submit(("A", "BUY"), ["buy 100"], intent="buy")
+    pipeline.submit(("A", "SELL"), ["sell 120"], intent="sell")
+    pipeline.clear()
+    pipeline.flush()
+
+    assert sent_orders == []
+    assert dropped_intents == ["buy", "sell"]
+
+
+def test_flush_takes_a_token_per_order(clock):
+    sent_orders = []
+    pipeline = OrderPipeline(sent_orders.append, max_orders_per_second=10, batch_size=3)
+
+    pipeline.submit(("A", "BUY"), ["cancel 1", "buy 100"])
+    pipeline.submit(("B", "BUY"), ["cancel 2", "buy 200"])
+    pipeline.flush()
+    assert sent_orders == ["cancel 1", "buy 100"]
+
+    # one token left - the second entry needs two
+    clock.now = 0.05
+    pipeline.flush()
+    assert pipeline.pending() == 1
+
+    clock.now = 0.1
+    pipeline.flush()
+    assert sent_orders == ["cancel 1", "buy 100", "cancel 2", "buy 200"]
+
+
+def test_token_bucket_debt(clock):
+    bucket = TokenBucket(10, burst=2)
+
+    # more tokens than the burst size are taken from a full bucket, leaving it in debt
+    assert bucket.take(tokens=3)
+    assert not bucket.available()
+
+    clock.now = 0.1
+    assert not bucket.available()
+    clock.now = 0.2
+    assert bucket.available()
+    assert not bucket.available(tokens=2)
+
+    assert bucket.take(block=True, tokens=2)
+    assert clock.now == pytest.approx(0.3)
+
+
+def test_no_rate_limit():
+    bucket = TokenBucket(None)
+    assert all(bucket.take() for _ in range(100))
@@ -0,0 +1,41 @@
+"""
+Tests for the probability weighted payoff statistics.
+
+Usage:
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+from payoff_statistics import common_probabilities, parse_description, state_probabilities, weighted_statistics
+
+
+def test_parse_description():
+    assert parse_description("1000,0,250,750")[0] == [1000, 0, 250, 750]
+    assert parse_description("1000,0,250,750")[1] is None
+
+    payoffs, probabilities = parse_description("1000,0,250,750;4,3,2,1")
+    np.testing.assert_allclose(probabilities, [0.4, 0.3, 0.2, 0.1])
+
+    with pytest.raises(ValueError):
+        parse_description("1000,0,250,750;0.5,0.5")
+
+
+def test_common_probabilities():
+    np.testing.assert_allclose(common_probabilities(4, [None, None]), 0.25)
+    np.testing.assert_allclose(common_probabilities(4, []), 0.25)
+    skewed = state_probabilities(4, [0.4, 0.3, 0.2, 0.1])
+    np.testing.assert_allclose(common_probabilities(4, [skewed, skewed]), skewed)
+
+    with pytest.raises(ValueError):
+        common_probabilities(4, [skewed, None])
+
+
+def test_weighted_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    payoff_matrix = rng.integers(0, 1000, (5, 7)).astype(float)
+    probabilities = state_probabilities(7, rng.random(7))
+
+    mean_payoffs, covariance_matrix = weighted_statistics(payoff_matrix, probabilities, block_size=3)
+    np.testing.assert_allclose(mean_payoffs, payoff_matrix @ probabilities)
+    np.testing.assert_allclose(covariance_matrix, np.cov(payoff_matrix, aweights=probabilities, bias=True))
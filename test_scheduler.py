@@ -0,0 +1,81 @@
+"""
+Tests for the decision pass scheduler.
+
+Usage:
+    python -m pytest -q
+"""
+import pytest
+
+import market_sim
+import scheduler
+from scheduler import DecisionScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(scheduler, "time", fake_clock)
+    return fake_clock
+
+
+def test_zero_interval_runs_every_notification(clock):
+    passes = []
+    decision_scheduler = DecisionScheduler(lambda: passes.append(clock.now))
+
+    for _ in range(3):
+        decision_scheduler.notify()
+
+    assert len(passes) == 3
+    assert decision_scheduler.pending() == 0
+
+
+def test_notifications_within_interval_are_coalesced(clock):
+    passes = []
+    decision_scheduler = DecisionScheduler(lambda: passes.append(clock.now), min_interval=1.0)
+
+    decision_scheduler.notify()
+    clock.now = 0.5
+    decision_scheduler.notify(updates=2)
+    decision_scheduler.notify()
+    assert passes == [0.0]
+    assert decision_scheduler.pending() == 2
+
+    # the trailing pass waits for the interval, then runs once for the coalesced notifications
+    assert not decision_scheduler.run_pending()
+    clock.now = 1.0
+    assert decision_scheduler.run_pending()
+    assert passes == [0.0, 1.0]
+    assert decision_scheduler.pending() == 0
+    assert not decision_scheduler.run_pending()
+
+
+def test_cancel_drops_pending_notifications(clock):
+    passes = []
+    decision_scheduler = DecisionScheduler(lambda: passes.append(clock.now), min_interval=1.0)
+
+    decision_scheduler.notify()
+    decision_scheduler.notify()
+    decision_scheduler.cancel()
+    clock.now = 2.0
+    assert not decision_scheduler.run_pending()
+    assert passes == [0.0]
+
+
+def test_trailing_pass_runs_once_the_market_goes_quiet():
+    capm_bot_module = market_sim.load_capm_bot()
+    markets = market_sim.synthetic_markets(6, seed=0)
+    bot = capm_bot_module.CAPMBot("test", "", "", 0, decision_interval=0.01)
+    simulator = market_sim.MarketSimulator(bot, markets, 100000)
+    simulator.start()
+
+    simulator.replay(market_sim.synthetic_order_stream(list(simulator.markets.values()), 300))
+    assert bot._decision_scheduler.pending() == 0
+    assert simulator.latencies["periodic_tasks"]
@@ -0,0 +1,54 @@
+"""
+Tests for the parameter sweep.
+
+Usage:
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+import market_sim
+import sweep
+
+capm_bot_module = market_sim.load_capm_bot()
+
+
+def test_parameter_grid():
+    grid = sweep._parse_grid(["risk_penalty=0.002,0.007", "proactive_orders=1,3", "statistics_dtype=float32"])
+    assert grid == {"risk_penalty": [0.002, 0.007], "proactive_orders": [1, 3], "statistics_dtype": ["float32"]}
+
+    configurations = sweep.parameter_grid(grid)
+    assert len(configurations) == 4
+    assert configurations[1] == {"risk_penalty": 0.002, "proactive_orders": 3, "statistics_dtype": "float32"}
+
+
+@pytest.mark.parametrize("probabilities", [None, "0.4,0.3,0.2,0.1"])
+def test_evaluate_performance_matches_simulator(probabilities):
+    markets = market_sim.synthetic_markets(5, seed=3)
+    if probabilities is not None:
+        for market in markets:
+            market.description += ";" + probabilities
+    simulator = market_sim.MarketSimulator(capm_bot_module.CAPMBot("test", "", "", 0), markets, 0)
+
+    rng = np.random.default_rng(4)
+    units = rng.integers(-5, 10, (6, len(markets)))
+    cash = rng.integers(0, 200000, 6)
+    risk_penalties = [0.002, 0.007, 0.02, 0.007, 0.0, 0.05]
+    performance = sweep.evaluate_performance(markets, units, cash, risk_penalties)
+
+    for run in range(len(units)):
+        simulator.units = {market.fm_id: int(units[run, market_index]) for market_index, market in enumerate(markets)}
+        simulator.cash = int(cash[run])
+        assert performance[run] == pytest.approx(simulator.performance(risk_penalties[run]))
+
+
+def test_sweep_runs_every_configuration():
+    markets = market_sim.synthetic_markets(4, seed=0)
+    order_events = list(market_sim.synthetic_order_stream(markets, 200))
+    configurations = sweep.parameter_grid({"risk_penalty": [0.002, 0.02]})
+    rows = sweep.sweep(markets, order_events, configurations, processes=2)
+
+    assert [row["risk_penalty"] for row in rows] == [0.002, 0.02]
+    for row in rows:
+        assert row["orders_sent"] >= row["orders_rejected"]
+        assert np.isfinite(row["performance"]) and np.isfinite(row["common_performance"])